@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+import json
 import os
+from socket import gethostname
 import sys
 
 from charmhelpers.core.hookenv import (
@@ -9,8 +11,10 @@ from charmhelpers.core.hookenv import (
     config,
     log,
     relation_get,
+    relation_id,
     relation_ids,
     related_units,
+    relation_set,
     status_set,
     application_version_set,
 )
@@ -28,13 +32,24 @@ from subprocess import (
 )
 from contrail_agent_utils import (
     configure_vrouter_interface,
+    configure_mtu,
+    configure_sriov,
+    configure_agent_cpu_affinity,
+    get_pci_whitelist,
+    get_tenant_mtu,
     drop_caches,
     dkms_autoinstall,
     update_vrouter_provision_status,
     write_configs,
     update_unit_status,
     reprovision_vrouter,
+    restart_agent_if_due,
+    collect_agent_metrics,
+    publish_agent_metrics,
+    SYSCTL_FILE,
+    SYSCTL_PROFILES,
 )
+from sysctl_utils import configure_sysctl
 
 PACKAGES = ["contrail-vrouter-dkms", "contrail-vrouter-agent",
             "contrail-vrouter-common", "contrail-setup",
@@ -99,11 +114,34 @@ def config_changed():
             raise Exception("Configuration parameter {} couldn't be changed"
                             .format(key))
 
+    configure_sysctl(SYSCTL_PROFILES, SYSCTL_FILE)
+    if config.changed("agent-cpuset"):
+        configure_agent_cpu_affinity()
+
+    sriov_changed = any(config.changed(key) for key in (
+        "sriov-physical-interface", "sriov-numvfs", "sriov-physical-network"))
+    if sriov_changed:
+        configure_sriov()
+    if config.changed("physical-interface-mtu"):
+        configure_mtu()
+    if sriov_changed or config.changed("physical-interface-mtu"):
+        update_northbound_relations()
+
     write_configs()
     if config.changed("control-network"):
         reprovision_vrouter()
 
 
+def update_northbound_relations(rid=None):
+    settings = {
+        "tenant-mtu": get_tenant_mtu(),
+        "hostname": gethostname(),
+        "pci-whitelist": json.dumps(get_pci_whitelist()),
+    }
+    for rid in ([rid] if rid else relation_ids("contrail-controller")):
+        relation_set(relation_id=rid, relation_settings=settings)
+
+
 @hooks.hook("contrail-controller-relation-changed")
 def contrail_controller_changed():
     data = relation_get()
@@ -120,9 +158,11 @@ def contrail_controller_changed():
     _update_config("ssl_ca", "ssl-ca")
     _update_config("auth_info", "auth-info")
     _update_config("orchestrator_info", "orchestrator-info")
+    _update_config("graceful_restart_info", "graceful-restart-info")
     config["vrouter-expected-provision-state"] = True
     config.save()
 
+    update_northbound_relations(rid=relation_id())
     write_configs()
     update_vrouter_provision_status()
     update_unit_status()
@@ -142,8 +182,15 @@ def contrail_controller_node_departed():
 
 @hooks.hook("update-status")
 def update_status():
+    restart_agent_if_due()
     update_vrouter_provision_status()
     update_unit_status()
+    collect_agent_metrics()
+
+
+@hooks.hook("collect-metrics")
+def collect_metrics():
+    publish_agent_metrics()
 
 
 def main():
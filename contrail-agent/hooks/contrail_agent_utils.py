@@ -1,22 +1,29 @@
 from base64 import b64decode
 import functools
+from glob import glob
+import hashlib
+from multiprocessing import cpu_count
 import os
+import random
+import re
 from socket import gethostname
 from subprocess import (
+    CalledProcessError,
     check_call,
     check_output,
 )
-from time import sleep, time
+from time import time
+from xml.etree import ElementTree
 
 import apt_pkg
 import json
-
-import netaddr
-import netifaces
+import requests
 
 from charmhelpers.contrib.network.ip import get_address_in_network
 from charmhelpers.core.hookenv import (
+    add_metric,
     config,
+    local_unit,
     log,
     related_units,
     relation_get,
@@ -27,60 +34,86 @@ from charmhelpers.core.hookenv import (
 )
 
 from charmhelpers.core.host import (
-    restart_on_change,
+    init_is_systemd,
+    path_hash,
+    restart_on_change_helper,
     write_file,
     service_restart,
+    service_running,
+    get_nic_mtu,
+    set_nic_mtu,
 )
 
 from charmhelpers.core.templating import render
 
+from contrail_api_utils import (
+    delete_virtual_router,
+    ensure_virtual_router,
+)
+from network_utils import (
+    get_gateway,
+    get_iface_addr,
+    get_link,
+    get_slaves,
+    get_vhost_phys,
+)
+
 apt_pkg.init()
 config = config()
 
 
 # as it's hardcoded in several scripts/configs
 VROUTER_INTERFACE = "vhost0"
-
-
-def retry(f=None, timeout=10, delay=2):
-    """Retry decorator.
-
-    Provides a decorator that can be used to retry a function if it raises
-    an exception.
-
-    :param timeout: timeout in seconds (default 10)
-    :param delay: retry delay in seconds (default 2)
-
-    Examples::
-
-        # retry fetch_url function
-        @retry
-        def fetch_url():
-            # fetch url
-
-        # retry fetch_url function for 60 secs
-        @retry(timeout=60)
-        def fetch_url():
-            # fetch url
-    """
-    if not f:
-        return functools.partial(retry, timeout=timeout, delay=delay)
-
-    @functools.wraps(f)
-    def func(*args, **kwargs):
-        start = time()
-        error = None
-        while True:
-            try:
-                return f(*args, **kwargs)
-            except Exception as e:
-                error = e
-            elapsed = time() - start
-            if elapsed >= timeout:
-                raise error
-            remaining = timeout - elapsed
-            sleep(delay if delay <= remaining else remaining)
-    return func
+VROUTER_INTERFACE_CONFIG = "/etc/network/interfaces.d/vrouter.cfg"
+IFUPDOWN_CONFIGS = ["/etc/network/interfaces",
+                    "/etc/network/interfaces.d/*.cfg"]
+
+CA_CERT_PATH = "/etc/contrail/ssl/certs/ca-cert.pem"
+AGENT_CONFIG = "/etc/contrail/contrail-vrouter-agent.conf"
+NODEMGR_CONFIG = "/etc/contrail/contrail-vrouter-nodemgr.conf"
+AGENT_INTROSPECT_PORT = 8085
+AGENT_INTROSPECT_TIMEOUT = 5
+# counter line of dropstats output: "<reason> <count>"
+DROPSTATS_LINE = re.compile(r"^\s*(\S.*?)\s+(\d+)\s*$")
+# agent is remediated at most this number of times with delays of
+# 2, 4, 8... minutes between steps
+AGENT_REMEDIATION_ATTEMPTS = 5
+AGENT_REMEDIATION_DELAY = 60
+# keys that vrouter-agent re-reads on SIGHUP without restart
+AGENT_RELOADABLE_KEYS = {
+    ("CONTROL-NODE", "servers"),
+    ("DNS", "servers"),
+    ("DEFAULT", "collectors"),
+}
+
+SRIOV_UDEV_RULES = "/etc/udev/rules.d/70-contrail-sriov.rules"
+# drivers that hold virtual functions passed through to instances
+SRIOV_PASSTHROUGH_DRIVERS = ("vfio-pci", "pci-stub")
+
+AGENT_SYSTEMD_DROPIN = ("/etc/systemd/system/contrail-vrouter-agent.service.d/"
+                        "cpu-affinity.conf")
+
+SYSCTL_FILE = "/etc/sysctl.d/60-contrail-agent.conf"
+SYSCTL_PROFILES = {
+    # computes forward lots of small packets for many flows
+    "compute-highpps": {
+        "net.core.netdev_max_backlog": 300000,
+        "net.core.netdev_budget": 600,
+        "net.core.rmem_max": 67108864,
+        "net.core.wmem_max": 67108864,
+        "net.core.rmem_default": 1048576,
+        "net.core.wmem_default": 1048576,
+        "net.core.somaxconn": 4096,
+        "net.netfilter.nf_conntrack_max": 1048576,
+        "net.ipv4.neigh.default.gc_thresh1": 4096,
+        "net.ipv4.neigh.default.gc_thresh2": 8192,
+        "net.ipv4.neigh.default.gc_thresh3": 16384,
+    },
+}
+
+# overhead of the largest supported encapsulation - VXLAN over IPv4:
+# outer IP (20) + UDP (8) + VXLAN (8) + inner Ethernet (14)
+ENCAPSULATION_OVERHEAD = 50
 
 
 def configure_vrouter_interface():
@@ -88,10 +121,229 @@ def configure_vrouter_interface():
     args = ["./create-vrouter.sh"]
     if config["remove-juju-bridge"]:
         args.append("-b")
+    mtu = config.get("physical-interface-mtu")
+    if mtu:
+        args.extend(["-m", str(mtu)])
     iface = config.get("physical-interface")
     if iface:
         args.append(iface)
-    check_call(args, cwd="scripts")
+    # script reports how long connectivity was interrupted
+    output = check_output(args, cwd="scripts")
+    log(output.decode('UTF-8'))
+
+
+def configure_mtu():
+    """Applies configured MTU to physical interface, its bond members and
+    vhost0 and stores it in the interfaces config of vRouter and in stanzas
+    of bond members.
+    """
+    mtu = config.get("physical-interface-mtu")
+    if not mtu:
+        return
+    mtu = str(mtu)
+
+    phys = vhost_phys(VROUTER_INTERFACE)
+    ifaces = get_slaves(phys) + [phys, VROUTER_INTERFACE]
+    # upper interfaces can't have MTU bigger than lower ones
+    if int(mtu) < int(get_nic_mtu(phys)):
+        ifaces.reverse()
+    for iface in ifaces:
+        if get_nic_mtu(iface) != mtu:
+            log("Set MTU {} on {}".format(mtu, iface))
+            set_nic_mtu(iface, mtu)
+
+    for slave in get_slaves(phys):
+        if not _persist_mtu(slave, mtu):
+            # bond applies its MTU to members without own stanza
+            log("Stanza of {} is absent, its MTU is not stored"
+                .format(slave), level=WARNING)
+
+    if not os.path.exists(VROUTER_INTERFACE_CONFIG):
+        return
+    with open(VROUTER_INTERFACE_CONFIG) as f:
+        data = f.read()
+    new_data = re.sub(r"(ip link set dev \S+ mtu )\d+", r"\g<1>" + mtu, data)
+    if new_data != data:
+        write_file(VROUTER_INTERFACE_CONFIG, new_data, perms=0o644)
+
+
+def _persist_mtu(iface, mtu):
+    """Stores MTU in ifupdown stanza of interface with pre-up command like
+    vRouter config does for physical interface.
+
+    Returns False if stanza of interface is absent.
+    """
+    stanza = re.compile(r"^\s*iface\s+{}\s".format(re.escape(iface)))
+    stanza_end = re.compile(r"^\s*(iface|mapping|auto|allow-\S+|source)\s")
+    command = re.compile(r"^(\s*pre-up\s+ip link set dev {} mtu )\d+\s*$"
+                         .format(re.escape(iface)))
+    line = "    pre-up ip link set dev {} mtu {}\n".format(iface, mtu)
+    paths = [path for pattern in IFUPDOWN_CONFIGS
+             for path in sorted(glob(pattern))]
+    for path in paths:
+        with open(path) as f:
+            lines = f.readlines()
+        start = next((i for i, l in enumerate(lines) if stanza.match(l)), None)
+        if start is None:
+            continue
+        end = next((i for i in range(start + 1, len(lines))
+                    if stanza_end.match(lines[i])), len(lines))
+        new_lines = list(lines)
+        for i in range(start + 1, end):
+            if command.match(lines[i]):
+                new_lines[i] = command.sub(r"\g<1>" + mtu, lines[i]) + "\n"
+                break
+        else:
+            new_lines.insert(start + 1, line)
+        if new_lines != lines:
+            write_file(path, "".join(new_lines), perms=0o644)
+        return True
+    return False
+
+
+def get_tenant_mtu():
+    mtu = config.get("physical-interface-mtu")
+    if not mtu:
+        try:
+            mtu = get_nic_mtu(VROUTER_INTERFACE)
+        except Exception as e:
+            log("Couldn't get MTU of {}: {}".format(VROUTER_INTERFACE, e),
+                level=WARNING)
+    return int(mtu) - ENCAPSULATION_OVERHEAD if mtu else None
+
+
+def _get_used_vfs(device):
+    """Returns virtual functions of device that are passed through to
+    instances or used by macvtap interfaces.
+    """
+    used = list()
+    for vf in sorted(os.listdir(device)):
+        if not vf.startswith("virtfn"):
+            continue
+        path = os.path.join(device, vf)
+        driver = os.path.join(path, "driver")
+        if (os.path.exists(driver) and os.path.basename(
+                os.path.realpath(driver)) in SRIOV_PASSTHROUGH_DRIVERS):
+            used.append(vf)
+            continue
+        net = os.path.join(path, "net")
+        for name in (os.listdir(net) if os.path.isdir(net) else []):
+            if any(entry.startswith("upper_")
+                   for entry in os.listdir(os.path.join(net, name))):
+                used.append(vf)
+                break
+    return used
+
+
+def configure_sriov():
+    """Creates SR-IOV virtual functions on configured interface and makes
+    them persistent through udev rule.
+
+    Number of virtual functions can be changed only through zero, so it's
+    not changed while any of them is used by instances.
+    """
+    iface = config.get("sriov-physical-interface")
+    numvfs = config.get("sriov-numvfs")
+    if not iface or not numvfs:
+        if os.path.exists(SRIOV_UDEV_RULES):
+            os.remove(SRIOV_UDEV_RULES)
+        return
+    if not config.get("sriov-physical-network"):
+        raise Exception("sriov-physical-network must be set for SR-IOV "
+                        "interface " + iface)
+
+    device = "/sys/class/net/{}/device".format(iface)
+    totalvfs_path = os.path.join(device, "sriov_totalvfs")
+    if not os.path.exists(totalvfs_path):
+        raise Exception("Interface {} doesn't support SR-IOV".format(iface))
+    with open(totalvfs_path) as f:
+        totalvfs = int(f.read())
+    if numvfs > totalvfs:
+        raise Exception("Interface {} supports only {} virtual functions"
+                        .format(iface, totalvfs))
+
+    numvfs_path = os.path.join(device, "sriov_numvfs")
+    with open(numvfs_path) as f:
+        current = int(f.read())
+    if current != numvfs:
+        used = _get_used_vfs(device) if current else []
+        if used:
+            raise Exception(
+                "Number of virtual functions on {} can't be changed from {} "
+                "while they are used by instances: {}".format(
+                    iface, current, ", ".join(used)))
+        log("Create {} virtual functions on {}".format(numvfs, iface))
+        # number of VFs can be changed only from zero
+        if current:
+            with open(numvfs_path, "w") as f:
+                f.write("0\n")
+        with open(numvfs_path, "w") as f:
+            f.write("{}\n".format(numvfs))
+
+    rule = ('ACTION=="add", SUBSYSTEM=="net", KERNEL=="{}", '
+            'ATTR{{device/sriov_numvfs}}="{}"\n'.format(iface, numvfs))
+    write_file(SRIOV_UDEV_RULES, rule, perms=0o644)
+
+
+def _parse_cpu_list(value):
+    """Converts list like '0-3,8' to the list of CPU numbers."""
+    cpus = set()
+    for item in value.split(","):
+        item = item.strip()
+        if "-" in item:
+            first, last = item.split("-", 1)
+            cpus.update(range(int(first), int(last) + 1))
+        elif item:
+            cpus.add(int(item))
+    return sorted(cpus)
+
+
+def configure_agent_cpu_affinity():
+    """Pins vrouter-agent to CPUs from 'agent-cpuset' option.
+
+    Affinity is stored in systemd drop-in for next starts of the service and
+    is applied to threads of running agent, so restart is not needed.
+    """
+    value = config.get("agent-cpuset")
+    try:
+        cpus = _parse_cpu_list(value) if value else None
+    except ValueError:
+        raise Exception("Invalid CPU list in agent-cpuset: {}".format(value))
+    if cpus and cpus[-1] >= cpu_count():
+        raise Exception("agent-cpuset refers to absent CPU {}"
+                        .format(cpus[-1]))
+    if not cpus:
+        cpus = list(range(cpu_count()))
+
+    if init_is_systemd():
+        if value:
+            content = "[Service]\nCPUAffinity={}\n".format(
+                " ".join(str(cpu) for cpu in cpus))
+            write_file(AGENT_SYSTEMD_DROPIN, content, perms=0o644)
+        elif os.path.exists(AGENT_SYSTEMD_DROPIN):
+            os.remove(AGENT_SYSTEMD_DROPIN)
+        check_call(["systemctl", "daemon-reload"])
+    else:
+        log("CPU affinity is applied only to running vrouter-agent as "
+            "service is not managed by systemd", level=WARNING)
+
+    try:
+        pid = check_output(["pgrep", "-f", "^/usr/bin/contrail-vrouter-agent"])
+    except CalledProcessError:
+        # agent is not running, affinity will be applied on start
+        return
+    cpu_list = ",".join(str(cpu) for cpu in cpus)
+    for pid in pid.decode("UTF-8").split():
+        check_call(["taskset", "--all-tasks", "-pc", cpu_list, pid])
+
+
+def get_pci_whitelist():
+    iface = config.get("sriov-physical-interface")
+    if (not iface or not config.get("sriov-numvfs")
+            or not config.get("sriov-physical-network")):
+        return []
+    return [{"devname": iface,
+             "physical_network": config.get("sriov-physical-network")}]
 
 
 def drop_caches():
@@ -151,7 +403,7 @@ def get_control_network_ip(control_network=None):
         network = config.get("control-network")
     ip = get_address_in_network(network) if network else None
     if not ip:
-        ip = iface_addr(VROUTER_INTERFACE)["addr"]
+        ip = get_iface_addr(VROUTER_INTERFACE)["addr"]
     return ip
 
 
@@ -173,28 +425,14 @@ def reprovision_vrouter(old_ip):
 
 def provision_vrouter(op, self_ip=None):
     ip = self_ip if self_ip else get_control_network_ip()
-    api_ip, api_port = get_controller_address()
+    api = get_controller_address()
     identity = _load_json_from_config("auth_info")
-    params = [
-        "contrail-provision-vrouter",
-        "--host_name", gethostname(),
-        "--host_ip", ip,
-        "--api_server_ip", api_ip,
-        "--api_server_port", str(api_port),
-        "--oper", op]
-    if "keystone_admin_user" in identity:
-        params += [
-            "--admin_user", identity.get("keystone_admin_user"),
-            "--admin_password", identity.get("keystone_admin_password"),
-            "--admin_tenant_name", identity.get("keystone_admin_tenant")]
-
-    @retry(timeout=65, delay=20)
-    def _call():
-        check_call(params)
-        log("vrouter operation '{}' was successful".format(op))
-
     log("{} vrouter {}".format(op, ip))
-    _call()
+    if op == "add":
+        ensure_virtual_router(api, identity, gethostname(), ip)
+    else:
+        delete_virtual_router(api, identity, gethostname())
+    log("vrouter operation '{}' was successful".format(op))
 
 
 def get_controller_address():
@@ -206,34 +444,78 @@ def get_controller_address():
     return (ip, port) if ip and port else (None, None)
 
 
-def iface_addr(iface):
-    return netifaces.ifaddresses(iface)[netifaces.AF_INET][0]
-
-
-def vhost_ip(addr):
+def vhost_ip(iface):
     # return a vhost formatted address and mask - x.x.x.x/xx
-    addr = iface_addr(VROUTER_INTERFACE)
-    ip = addr["addr"]
-    cidr = netaddr.IPNetwork(ip + "/" + addr["netmask"]).prefixlen
-    return ip + "/" + str(cidr)
+    addr = get_iface_addr(iface)
+    return "{}/{}".format(addr["addr"], addr["prefixlen"])
 
 
 def vhost_gateway(iface):
     # determine vhost gateway
     gateway = config.get("vhost-gateway")
     if gateway == "auto":
-        for line in check_output(["route", "-n"]).splitlines()[2:]:
-            l = line.decode('UTF-8').split()
-            if "G" in l[3] and l[7] == iface:
-                return l[1]
-        gateway = None
+        gateway = get_gateway(iface)
     return gateway
 
 
+def _get_vrouter_phys(iface):
+    # physical interface attached to vrouter has MAC address of vhost
+    link = get_link(iface)
+    try:
+        output = check_output(["vif", "--list"]).decode("UTF-8")
+    except (OSError, CalledProcessError):
+        return None
+    for vif in output.split("\n\n"):
+        fields = vif.split()
+        if (len(fields) > 2 and "Type:Physical" in fields
+                and "HWaddr:" + link["mac"].lower() in fields):
+            return fields[2]
+    return None
+
+
 def vhost_phys(iface):
-    # run external script to determine physical interface of 'vhost0'
-    cmd = ["scripts/vhost-phys.sh", iface]
-    return (check_output(cmd).decode('UTF-8').rstrip())
+    # determine physical interface of 'vhost0'
+    if get_link(iface):
+        phys = _get_vrouter_phys(iface)
+        if phys:
+            return phys
+    return get_vhost_phys(iface)
+
+
+def get_tuning_context():
+    """Returns flow and task tuning of agent.
+
+    Thread counts that are not set in charm config are sized from number of
+    CPU cores of the host.
+    """
+    cores = cpu_count()
+    ctx = {
+        "flow_thread_count": (config.get("flow-thread-count")
+                              or max(2, min(cores // 4, 8))),
+        "task_thread_count": (config.get("task-thread-count")
+                              or max(2, min(cores // 2, 16))),
+    }
+    for key in ("max-vm-flows", "max-vm-linklocal-flows",
+                "max-system-linklocal-flows", "flow-add-tokens"):
+        ctx[key.replace("-", "_")] = config.get(key)
+    return ctx
+
+
+def _select_servers(servers, count):
+    """Selects stable subset of servers for this unit.
+
+    Rendezvous hashing of unit name and server address is used, so servers
+    are spread evenly across agents and adding or removing of a server
+    changes subsets only of agents that have this server.
+    """
+    if not count or len(servers) <= count:
+        return servers
+    unit = local_unit()
+
+    def _weight(server):
+        return hashlib.md5((unit + server).encode("UTF-8")).hexdigest()
+
+    return sorted(servers, key=_weight, reverse=True)[:count]
 
 
 def _load_json_from_config(key):
@@ -250,19 +532,26 @@ def get_context():
     ip, port = get_controller_address()
     ctx["api_server"] = ip
     ctx["api_port"] = port
-    ctx["control_nodes"] = [
+    control_nodes = [
         relation_get("private-address", unit, rid)
          for rid in relation_ids("contrail-controller")
          for unit in related_units(rid)]
-    ctx["analytics_nodes"] = _load_json_from_config("analytics_servers")
+    ctx["control_nodes"] = _select_servers(
+        control_nodes, config.get("control-nodes-per-agent"))
+    ctx["analytics_nodes"] = _select_servers(
+        _load_json_from_config("analytics_servers"),
+        config.get("collectors-per-agent"))
     info = _load_json_from_config("orchestrator_info")
     ctx["metadata_shared_secret"] = info.get("metadata_shared_secret")
+    ctx["headless_mode"] = config.get("headless-mode")
+    ctx["graceful_restart"] = _load_json_from_config("graceful_restart_info")
 
     ctx["control_network_ip"] = get_control_network_ip()
 
     ctx["vhost_ip"] = vhost_ip(VROUTER_INTERFACE)
     ctx["vhost_gateway"] = vhost_gateway(VROUTER_INTERFACE)
     ctx["vhost_physical"] = vhost_phys(VROUTER_INTERFACE)
+    ctx.update(get_tuning_context())
 
     log("CTX: " + str(ctx))
 
@@ -292,82 +581,295 @@ def _save_file(path, data):
         os.remove(path)
 
 
-@restart_on_change({
-    "/etc/contrail/ssl/certs/ca-cert.pem":
-        ["contrail-vrouter-agent", "contrail-vrouter-nodemgr"],
-    "/etc/contrail/contrail-vrouter-agent.conf":
-        ["contrail-vrouter-agent"],
-    "/etc/contrail/contrail-vrouter-nodemgr.conf":
-        ["contrail-vrouter-nodemgr"]})
 def write_configs():
+    # snapshot of the current state to decide later whether agent can apply
+    # changes of its config without restart
+    state = (path_hash(CA_CERT_PATH), _read_agent_config())
+    restart_on_change_helper(
+        _write_configs,
+        {CA_CERT_PATH: ["contrail-vrouter-agent", "contrail-vrouter-nodemgr"],
+         AGENT_CONFIG: ["contrail-vrouter-agent"],
+         NODEMGR_CONFIG: ["contrail-vrouter-nodemgr"]},
+        restart_functions={
+            "contrail-vrouter-agent": functools.partial(
+                _restart_or_reload_agent, state)})
+
+
+def _write_configs():
     ctx = get_context()
 
     # TODO: what we should do with two other certificates?
     # NOTE: store files in the same paths as in tepmlates
-    ca_path = "/etc/contrail/ssl/certs/ca-cert.pem"
     ssl_ca = ctx["ssl_ca"]
-    _save_file(ca_path, ssl_ca)
-    ctx["ssl_ca_path"] = ca_path
+    _save_file(CA_CERT_PATH, ssl_ca)
+    ctx["ssl_ca_path"] = CA_CERT_PATH
 
-    render("contrail-vrouter-nodemgr.conf",
-           "/etc/contrail/contrail-vrouter-nodemgr.conf", ctx)
+    render("contrail-vrouter-nodemgr.conf", NODEMGR_CONFIG, ctx)
     render("vnc_api_lib.ini", "/etc/contrail/vnc_api_lib.ini", ctx)
-    render("contrail-vrouter-agent.conf",
-           "/etc/contrail/contrail-vrouter-agent.conf", ctx, perms=0o440)
+    render("contrail-vrouter-agent.conf", AGENT_CONFIG, ctx, perms=0o440)
+
+
+def _read_agent_config():
+    """Returns agent config as dict {(section, key): value}"""
+    result = dict()
+    if not os.path.exists(AGENT_CONFIG):
+        return result
+    section = None
+    with open(AGENT_CONFIG) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("["):
+                section = line.strip("[]")
+                continue
+            key, _, value = line.partition("=")
+            result[(section, key.strip())] = value.strip()
+    return result
+
+
+def _restart_or_reload_agent(state, service_name):
+    old_ca_hash, old_config = state
+    new_config = _read_agent_config()
+    keys = set(old_config) | set(new_config)
+    changed = set(key for key in keys
+                  if old_config.get(key) != new_config.get(key))
+    if (path_hash(CA_CERT_PATH) == old_ca_hash and changed
+            and changed.issubset(AGENT_RELOADABLE_KEYS)):
+        log("Reload {} for changed keys: {}".format(service_name, changed))
+        try:
+            check_call(["pkill", "--signal", "HUP", "-f",
+                        "^/usr/bin/" + service_name])
+            return
+        except CalledProcessError as e:
+            log("Couldn't reload {}: {}".format(service_name, str(e)),
+                level=WARNING)
+    # agent without control nodes doesn't serve anything yet and gets its
+    # first config as soon as possible
+    configured = bool(old_config.get(("CONTROL-NODE", "servers")))
+    _schedule_agent_restart(immediate=not configured)
+
+
+def _schedule_agent_restart(immediate=False):
+    """Defers restart of vrouter-agent to a random moment within
+    'restart-spread' seconds, so agents don't reconnect to controllers all
+    at once after fleet-wide change of configuration.
+
+    Agent that is not running is restarted immediately.
+    """
+    spread = config.get("restart-spread")
+    if (not spread or immediate
+            or not service_running("contrail-vrouter-agent")):
+        service_restart("contrail-vrouter-agent")
+        config.pop("agent-restart-due", None)
+        return
+    if config.get("agent-restart-due"):
+        # restart is already scheduled and will apply all changes
+        return
+    due = time() + random.randint(0, spread)
+    config["agent-restart-due"] = due
+    log("Restart of contrail-vrouter-agent is deferred for {} seconds"
+        .format(int(due - time())))
+
+
+def restart_agent_if_due():
+    due = config.get("agent-restart-due")
+    if not due or time() < due:
+        return
+    log("Run deferred restart of contrail-vrouter-agent")
+    service_restart("contrail-vrouter-agent")
+    config.pop("agent-restart-due", None)
 
 
 def update_unit_status():
+    units = [unit for rid in relation_ids("contrail-controller")
+                      for unit in related_units(rid)]
+    if not units:
+        status_set("blocked", "Missing relation to contrail-controller")
+        return
     if not config.get("vrouter-provisioned"):
-        units = [unit for rid in relation_ids("contrail-controller")
-                          for unit in related_units(rid)]
-        if units:
-            status_set("waiting", "There is no enough info to provision.")
-        else:
-            status_set("blocked", "Missing relation to contrail-controller")
+        status_set("waiting", "There is no enough info to provision.")
+        return
+    # agent isn't remediated until it gets control nodes
+    if not _read_agent_config().get(("CONTROL-NODE", "servers")):
+        status_set("waiting", "vrouter-agent is not configured yet")
+        return
 
-    status, _ = _get_agent_status()
-    if status == 'initializing':
-        # some hacks
-        log("Run agent hack: service restart")
-        service_restart("contrail-vrouter-agent")
-        sleep(10)
-        status, msg = _get_agent_status()
-        if status == 'initializing' and "(No Configuration for self)" in msg:
-            log("Run agent hack: reinitialize config client")
-            ip = config.get("api_ip")
-            try:
-                # TODO: apply SSL if needed
-                check_call(
-                    ["curl", "-s",
-                     "http://{}:8083/Snh_ConfigClientReinitReq?".format(ip)])
-                sleep(5)
-                status, _ = _get_agent_status()
-            except Exception as e:
-                log("Reinitialize returns error: " + str(e))
+    try:
+        state, description, connections = _get_agent_status()
+    except Exception as e:
+        log("Couldn't get status of agent: " + str(e))
+        state, description, connections = None, "status is unavailable", []
 
-    if status == 'active':
+    if state == "Functional":
+        config.pop("agent-remediation-attempts", None)
+        config.pop("agent-remediation-time", None)
         status_set("active", "Unit is ready")
         return
 
-    status_set("waiting", "vrouter-agent is not up")
+    down = ["{} {}".format(ctype, name)
+            for ctype, name, status in connections if status != "Up"]
+    if down:
+        description += " (down: {})".format(", ".join(down))
+    if not _remediate_agent(description):
+        status_set("blocked", "vrouter-agent is not up and remediation "
+                   "attempts are exhausted: " + description)
+        return
+    status_set("waiting", "vrouter-agent is not up: " + description)
 
 
 def _get_agent_status():
-    """ Analyzes output of 'contrail-status' utility
+    """Reads NodeStatus of agent from its introspect port.
 
-    returns status from agent service:
+    Returns tuple (state, description, connections) where connections is a
+    list of tuples (type, name, status) for control nodes, collectors, etc.
     """
-    output = check_output("contrail-status", shell=True)
-    for line in output.splitlines()[1:]:
-        if len(line) == 0:
-            return
-        lst = line.decode('UTF-8').split()
-        if len(lst) < 2:
+    if config.get("ssl_ca"):
+        return _get_agent_status_from_cli()
+    root = _get_introspect("Snh_SandeshUVECacheReq?x=NodeStatus")
+    for process in root.iter("ProcessStatus"):
+        if process.findtext("module_id") != "contrail-vrouter-agent":
             continue
-        s_name = lst[0].strip()
-        s_status = lst[1].strip()
-        if 'contrail-vrouter-agent' not in s_name:
+        connections = [
+            (info.findtext("type"), info.findtext("name"),
+             info.findtext("status"))
+            for info in process.iter("ConnectionInfo")]
+        return (process.findtext("state"),
+                process.findtext("description") or "", connections)
+    return None, "agent status is absent in introspect", []
+
+
+def _get_agent_status_from_cli():
+    """Reads state of agent from contrail-status.
+
+    Connections are not reported by contrail-status, so the list is empty.
+    """
+    output = check_output(["contrail-status"]).decode("UTF-8")
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 2 or \
+                fields[0].split(":")[0] != "contrail-vrouter-agent":
             continue
+        if fields[1] == "active":
+            return "Functional", "", []
+        return fields[1], " ".join(fields[2:]).strip("()") or fields[1], []
+    return None, "agent is absent in contrail-status", []
+
+
+def _get_introspect(request):
+    # introspect with SSL requires client certificate that agent charm
+    # doesn't get from controller
+    if config.get("ssl_ca"):
+        raise Exception("introspect of agent is served over SSL")
+    url = "http://127.0.0.1:{}/{}".format(AGENT_INTROSPECT_PORT, request)
+    r = requests.get(url, timeout=AGENT_INTROSPECT_TIMEOUT)
+    r.raise_for_status()
+    return ElementTree.fromstring(r.content)
+
+
+def _get_drops():
+    output = check_output(["dropstats"]).decode("UTF-8")
+    drops = 0
+    for line in output.splitlines():
+        match = DROPSTATS_LINE.match(line)
+        if match:
+            drops += int(match.group(2))
+    return drops
+
+
+def _get_vif_count():
+    output = check_output(["vif", "--list"]).decode("UTF-8")
+    return len([line for line in output.splitlines()
+                if line.startswith("vif")])
+
+
+def collect_agent_metrics():
+    """Collects datapath metrics of agent for the collect-metrics hook.
+
+    Flow setup rate is calculated from the number of created flows since
+    previous collection. Drops are kept as total and are published as
+    difference with the previous publication. Flow metrics are not
+    collected when introspect is served over SSL.
+    """
+    try:
+        metrics = {
+            "drops-total": _get_drops(),
+            "vifs": _get_vif_count(),
+        }
+    except Exception as e:
+        log("Couldn't collect vrouter metrics: " + str(e), level=WARNING)
+        return
+    try:
+        stats = _get_introspect("Snh_AgentStatsReq").find(".//FlowStatsResp")
+        _, _, connections = _get_agent_status()
+        metrics["flows"] = int(stats.findtext("flow_active"))
+        metrics["xmpp-peers-up"] = len([
+            status for ctype, name, status in connections
+            if ctype == "XMPP" and status == "Up"])
+        created = int(stats.findtext("flow_created"))
+    except Exception as e:
+        log("Couldn't collect agent metrics: " + str(e), level=WARNING)
+        config["agent-metrics"] = metrics
+        return
+
+    now = time()
+    prev = config.get("agent-metrics-flows-created")
+    if prev and created >= prev[1]:
+        metrics["flow-setup-rate"] = int(
+            (created - prev[1]) / max(now - prev[0], 1))
+    config["agent-metrics-flows-created"] = (now, created)
+    config["agent-metrics"] = metrics
+
+
+def publish_agent_metrics():
+    metrics = dict(config.get("agent-metrics") or {})
+    if not metrics:
+        return
+    total = metrics.pop("drops-total")
+    published = config.get("agent-metrics-drops-published")
+    # counters start from zero when vrouter module is reloaded
+    if published is not None:
+        metrics["drops"] = total - published if total >= published else total
+    config["agent-metrics-drops-published"] = total
+    add_metric(*["{}={}".format(key, value)
+                 for key, value in metrics.items()])
+
+
+def _remediate_agent(description):
+    """Runs next remediation step for agent if its backoff delay passed.
+
+    Steps are tracked in charm state across hooks: first check only starts
+    grace period, each next step doubles the delay.
+    Returns False if all attempts are exhausted.
+    """
+    if config.get("agent-restart-due"):
+        # deferred restart will be done soon
+        return True
+    attempts = config.get("agent-remediation-attempts", 0)
+    next_time = config.get("agent-remediation-time")
+    if next_time is None:
+        config["agent-remediation-time"] = time() + AGENT_REMEDIATION_DELAY
+        return True
+    if time() < next_time:
+        return True
+    if attempts >= AGENT_REMEDIATION_ATTEMPTS:
+        return False
+
+    if "No Configuration for self" in description:
+        log("Agent remediation: reinitialize config client")
+        ip = config.get("api_ip")
+        try:
+            # TODO: apply SSL if needed
+            requests.get(
+                "http://{}:8083/Snh_ConfigClientReinitReq?".format(ip),
+                timeout=AGENT_INTROSPECT_TIMEOUT)
+        except Exception as e:
+            log("Reinitialize returns error: " + str(e))
+    else:
+        log("Agent remediation: service restart")
+        service_restart("contrail-vrouter-agent")
 
-        log("contrail-status: " + line)
-        return s_status, line
+    config["agent-remediation-attempts"] = attempts + 1
+    config["agent-remediation-time"] = (
+        time() + AGENT_REMEDIATION_DELAY * 2 ** (attempts + 1))
+    return True
@@ -4,13 +4,49 @@
 
 ARG_BRIDGE=b
 ARG_HELP=h
-OPTS=:${ARG_BRIDGE}${ARG_HELP}
+ARG_MTU=m
+OPTS=:${ARG_BRIDGE}${ARG_HELP}${ARG_MTU}:
 USAGE="\
-create-vrouter [-${ARG_BRIDGE}${ARG_HELP}] [interface]
+create-vrouter [-${ARG_BRIDGE}${ARG_HELP}] [-${ARG_MTU} mtu] [interface]
 Options:
   -$ARG_BRIDGE  remove bridge from interface if exists
+  -$ARG_MTU  set MTU of physical interface and vhost0
   -$ARG_HELP  print this message"
 
+canCutover()
+{
+	# addresses can be moved to vhost0 only for static configuration,
+	# DHCP configuration requires restart of interfaces
+	grep -q "^iface vhost0 inet static" $TMP/vrouter.cfg 2>/dev/null \
+	    && [ -n "$(ip -4 -o addr show dev $1)" ] \
+	    && [ ! -e /sys/class/net/vhost0 ]
+}
+
+checkGateway()
+{
+	[ -n "$(ip -4 -o addr show dev vhost0)" ] || return 1
+	gw=$(awk '$1 == "default" { print $3; exit }' $TMP/routes)
+	[ -n "$gw" ] || return 0
+	for i in 1 2 3 4 5; do
+		ping -c 1 -W 1 $gw > /dev/null 2>&1 && return 0
+	done
+	return 1
+}
+
+commitInterfaces()
+{
+	[ -e $TMP/changed ] || return 0
+	# configs are restored on rollback only after they are replaced
+	touch $TMP/committed
+	while read cfg new_cfg; do
+		# create backup
+		mv "$cfg" "$cfg.save"
+		# substitute replacement config for original config
+		{ cat juju-header; echo; cat $new_cfg; } > "$cfg"
+	done < $TMP/changed
+	cp $TMP/vrouter-interfaces.cfg /etc/network/interfaces.d/vrouter.cfg
+}
+
 configVRouter()
 {
 	cat juju-header
@@ -27,9 +63,12 @@ configVRouter()
 		echo "iface vhost0 inet dhcp"
 	fi
 	cat <<-EOF
-		    pre-up ip link add vhost0 address \$(cat /sys/class/net/$1/address) type vhost
-		    pre-up vif --add $1 --mac \$(cat /sys/class/net/$1/address) --vrf 0 --vhost-phys --type physical
-		    pre-up vif --add vhost0 --mac \$(cat /sys/class/net/$1/address) --vrf 0 --type vhost --xconnect $1
+		    pre-up ip link set dev $1 mtu $4
+		    pre-up [ -e /sys/class/net/vhost0 ] || { \\
+		        ip link add vhost0 address \$(cat /sys/class/net/$1/address) type vhost && \\
+		        vif --add $1 --mac \$(cat /sys/class/net/$1/address) --vrf 0 --vhost-phys --type physical && \\
+		        vif --add vhost0 --mac \$(cat /sys/class/net/$1/address) --vrf 0 --type vhost --xconnect $1; }
+		    pre-up ip link set dev vhost0 mtu $4
 		    post-down vif --list | awk '/^vif.*OS: vhost0/ {split(\$1, arr, "\\/"); print arr[2];}' | xargs vif --delete
 		    post-down vif --list | awk '/^vif.*OS: $1/ {split(\$1, arr, "\\/"); print arr[2];}' | xargs vif --delete
 		    post-down ip link delete vhost0
@@ -38,20 +77,20 @@ configVRouter()
 
 configureInterfaces()
 {
+	n=0
 	for cfg in /etc/network/interfaces /etc/network/interfaces.d/*.cfg \
 	    /etc/network/*.config; do
 		# for each network interfaces config, extract the config for
 		# the chosen interface whilst commenting it out in the
 		# subsequent replacement config
 		[ -e "$cfg" ] || continue
+		n=$(($n + 1))
 		awk -v interface=$1 -v interface_cfg=$TMP/interface.cfg \
 		    -v vrouter_cfg=$TMP/vrouter.cfg -f vrouter-interfaces.awk \
-		    "$cfg" > $TMP/interfaces.cfg
-		if ! diff $TMP/interfaces.cfg "$cfg" > /dev/null; then
-			# create backup
-			mv "$cfg" "$cfg.save"
-			# substitute replacement config for original config
-			{ cat juju-header; echo; cat $TMP/interfaces.cfg; } > "$cfg"
+		    "$cfg" > $TMP/interfaces.$n.cfg
+		if ! diff $TMP/interfaces.$n.cfg "$cfg" > /dev/null; then
+			# replacement is stored by commitInterfaces
+			echo "$cfg $TMP/interfaces.$n.cfg" >> $TMP/changed
 		fi
 	done
 	if [ -e $TMP/interface.cfg ]; then
@@ -92,13 +131,80 @@ configureVRouter()
 		iface_up=$1
 		iface_cfg=/dev/null
 	fi
-	ifacedown $iface_down vhost0; sleep 5
+	# interface that holds addresses now
+	iface_addr=${2:-$1}
+	# keep MTU of the interface if it is not specified explicitly
+	mtu=${mtu:-$(cat /sys/class/net/$iface_up/mtu)}
 	configureInterfacesDir
 	configureInterfaces $iface_delete
-	configVRouter $iface_up $iface_cfg $TMP/vrouter.cfg \
-	    > /etc/network/interfaces.d/vrouter.cfg
+	configVRouter $iface_up $iface_cfg $TMP/vrouter.cfg $mtu \
+	    > $TMP/vrouter-interfaces.cfg
+
+	if canCutover $iface_addr; then
+		if cutoverVRouter $iface_up $iface_addr; then
+			# remove bridge that is not needed anymore
+			[ "$iface_addr" = "$iface_up" ] \
+			    || ifdown -v --force $iface_addr || true
+			restoreRoutes
+			echo "vhost0 cutover: connectivity was interrupted for" \
+			    "$(($(timeMs) - outage_start)) ms"
+			return
+		fi
+		echo "vhost0 cutover failed, rolling back" >&2
+		rollbackVRouter $iface_up $iface_addr
+		echo "vhost0 rollback: connectivity was interrupted for" \
+		    "$(($(timeMs) - outage_start)) ms" >&2
+		exit 1
+	fi
+
+	outage_start=$(timeMs)
+	ifacedown $iface_down vhost0; sleep 5
+	commitInterfaces
 	ifaceup $iface_up vhost0
 	restoreRoutes
+	echo "vhost0 restart: connectivity was interrupted for" \
+	    "$(($(timeMs) - outage_start)) ms"
+}
+
+cutoverVRouter()
+{
+	# prepare vhost0 while interfaces are still up then move addresses
+	# to vhost0 with ifup, so ifupdown knows that vhost0 is up, restore
+	# routes and check that gateway is reachable
+	ip -4 -o addr show dev $2 | awk '{ print $4 }' > $TMP/addrs
+	ip -4 route show dev $2 | grep -v "proto kernel" > $TMP/routes || true
+	mac=$(cat /sys/class/net/$1/address)
+	ip link set dev $1 mtu $mtu || return 1
+	ip link add vhost0 address $mac type vhost || return 1
+	ip link set dev vhost0 mtu $mtu || return 1
+	commitInterfaces
+
+	outage_start=$(timeMs)
+	if [ "$1" != "$2" ]; then
+		ip link set dev $1 nomaster || return 1
+	fi
+	vif --add $1 --mac $mac --vrf 0 --vhost-phys --type physical \
+	    || return 1
+	vif --add vhost0 --mac $mac --vrf 0 --type vhost --xconnect $1 \
+	    || return 1
+	delAddrs $2
+	ifup -v vhost0 || return 1
+	addRoutes vhost0
+	checkGateway
+}
+
+delAddrs()
+{
+	while read addr; do
+		echo "addr del $addr dev $1"
+	done < $TMP/addrs | ip -force -batch - || true
+}
+
+addRoutes()
+{
+	while read route; do
+		echo "route replace $route dev $1"
+	done < $TMP/routes | ip -force -batch - || true
 }
 
 ifacebridge()
@@ -147,6 +253,23 @@ ifaceup()
 	return 0
 }
 
+moveAddrs()
+{
+	# all changes are sent through one netlink socket
+	{
+		while read addr; do
+			echo "addr del $addr dev $1"
+		done < $TMP/addrs
+		while read addr; do
+			echo "addr add $addr dev $2"
+		done < $TMP/addrs
+		echo "link set dev $2 up"
+		while read route; do
+			echo "route replace $route dev $2"
+		done < $TMP/routes
+	} | ip -force -batch - || true
+}
+
 restoreRoutes()
 {
 	if [ -e /etc/network/routes ]; then
@@ -169,6 +292,30 @@ restoreSlaves()
 	fi
 }
 
+rollbackInterfaces()
+{
+	[ -e $TMP/committed ] || return 0
+	while read cfg new_cfg; do
+		[ -e "$cfg.save" ] && mv "$cfg.save" "$cfg"
+	done < $TMP/changed
+	rm -f /etc/network/interfaces.d/vrouter.cfg
+}
+
+rollbackVRouter()
+{
+	# vhost0 is taken down by ifupdown while its config still exists,
+	# addresses that are already removed are added back to interface
+	ifdown -v --force vhost0 || true
+	vifDelete vhost0
+	vifDelete $1
+	moveAddrs vhost0 $2
+	ip link delete vhost0 2>/dev/null || true
+	rollbackInterfaces
+	if [ "$1" != "$2" ]; then
+		ip link set dev $1 master $2 || true
+	fi
+}
+
 saveIfaces()
 {
 	if [ -z "$(find /sys/class/net/$1/brif -maxdepth 0 -empty)" ]; then
@@ -185,6 +332,11 @@ saveSlaves()
 	fi
 }
 
+timeMs()
+{
+	echo $(($(date +%s%N) / 1000000))
+}
+
 usage()
 {
 	if [ $# -gt 0 ]; then
@@ -202,6 +354,13 @@ usageError()
 	exit 1
 }
 
+vifDelete()
+{
+	vif --list \
+	    | awk -v iface=$1 '$0 ~ "^vif.*OS: " iface "( |$)" { split($1, arr, "/"); print arr[2]; }' \
+	    | xargs -r -n 1 vif --delete || true
+}
+
 while getopts $OPTS opt; do
 	case $opt in
 	$ARG_BRIDGE)
@@ -211,6 +370,12 @@ while getopts $OPTS opt; do
 		usage
 		exit 0
 		;;
+	$ARG_MTU)
+		mtu=$OPTARG
+		;;
+	":")
+		usageError "Missing value for argument: $OPTARG"
+		;;
 	"?")
 		usageError "Unknown argument: $OPTARG"
 		;;
@@ -237,7 +402,8 @@ if [ $# -ne 0 ]; then
 	fi
 else
 	# use default gateway interface
-	gateway=$(route -n | awk '$1 == "0.0.0.0" { print $8 }')
+	gateway=$(ip -4 route show default \
+	    | awk '{ for (i = 1; i < NF; i++) if ($i == "dev") { print $(i + 1); exit } }')
 	if [ -d /sys/class/net/$gateway/bridge ] \
 	    && [ -z "$(find /sys/class/net/$gateway/brif -maxdepth 0 -empty)" ] \
 	    && [ -n "$remove_bridge" ]; then
@@ -0,0 +1,151 @@
+import json
+import os
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import network_utils
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+
+def load_state(name):
+    # dumps are recorded with 'ip -d -j link show'
+    with open(os.path.join(DATA_DIR, name)) as f:
+        return network_utils.parse_iproute2(json.load(f), [])
+
+
+class TestParseIproute2(unittest.TestCase):
+
+    def test_links(self):
+        links = load_state("ip-link-vlan.json")["links"]
+        self.assertEqual(links["ens3.100"]["kind"], "vlan")
+        self.assertEqual(links["ens3.100"]["parent"], "ens3")
+        self.assertIsNone(links["ens3"]["parent"])
+        self.assertEqual(links["ens3"]["mac"], "52:54:00:6a:11:01")
+
+    def test_bond(self):
+        state = load_state("ip-link-bond.json")
+        self.assertEqual(state["links"]["bond0"]["kind"], "bond")
+        with mock.patch.object(network_utils, "get_network_state",
+                               return_value=state):
+            self.assertEqual(network_utils.get_slaves("bond0"),
+                             ["ens3", "ens4"])
+
+    def test_addrs_and_routes(self):
+        links = [{"ifname": "vhost0", "address": "52:54:00:6a:11:01",
+                  "mtu": 1500,
+                  "addr_info": [
+                      {"family": "inet", "local": "10.0.0.5",
+                       "prefixlen": 24},
+                      {"family": "inet6", "local": "fe80::1",
+                       "prefixlen": 64}]}]
+        routes = [{"dst": "default", "gateway": "10.0.0.1",
+                   "dev": "vhost0"},
+                  {"dst": "10.0.0.0/24", "dev": "vhost0"},
+                  {"dst": "10.1.0.7", "gateway": "10.0.0.2",
+                   "dev": "vhost0"}]
+        state = network_utils.parse_iproute2(links, routes)
+        self.assertEqual(state["links"]["vhost0"]["addrs"],
+                         [{"addr": "10.0.0.5", "prefixlen": 24}])
+        self.assertEqual(
+            [(r["dst"], r["dst_len"]) for r in state["routes"]],
+            [("0.0.0.0", 0), ("10.0.0.0", 24), ("10.1.0.7", 32)])
+
+
+class TestParseNetlink(unittest.TestCase):
+
+    def setUp(self):
+        # dump of pyroute2 messages of IPRoute get_links, get_addr and
+        # get_routes
+        with open(os.path.join(DATA_DIR, "netlink-bond-vlan.json")) as f:
+            dump = json.load(f)
+        self.state = network_utils.parse_netlink(
+            dump["links"], dump["addrs"], dump["routes"])
+
+    def test_links(self):
+        links = self.state["links"]
+        self.assertEqual(links["bond0"]["kind"], "bond")
+        self.assertEqual(links["ens3"]["master"], "bond0")
+        self.assertEqual(links["bond0.100"]["kind"], "vlan")
+        self.assertEqual(links["bond0.100"]["parent"], "bond0")
+        self.assertIsNone(links["bond0"]["parent"])
+        self.assertEqual(links["vhost0"]["mtu"], 9000)
+
+    def test_addrs_and_routes(self):
+        self.assertEqual(self.state["links"]["vhost0"]["addrs"],
+                         [{"addr": "10.0.0.5", "prefixlen": 24}])
+        # route of local table is skipped
+        self.assertEqual(
+            [(r["dst"], r["dst_len"], r["gateway"], r["dev"])
+             for r in self.state["routes"]],
+            [("0.0.0.0", 0, "10.0.0.1", "vhost0"),
+             ("10.0.0.0", 24, None, "vhost0")])
+
+
+class TestParseSysfs(unittest.TestCase):
+
+    def setUp(self):
+        addrs = {"vhost0": {network_utils.netifaces.AF_INET: [
+            {"addr": "10.0.0.5", "netmask": "255.255.255.0"}]}}
+        with mock.patch.object(network_utils.netifaces, "ifaddresses",
+                               side_effect=lambda name: addrs.get(name, {})):
+            self.state = network_utils.parse_sysfs(
+                os.path.join(DATA_DIR, "sys-class-net"),
+                os.path.join(DATA_DIR, "proc-net-route"))
+
+    def test_links(self):
+        links = self.state["links"]
+        self.assertEqual(links["bond0"]["kind"], "bond")
+        self.assertEqual(links["ens4"]["master"], "bond0")
+        self.assertEqual(links["bond0.100"]["kind"], "vlan")
+        self.assertEqual(links["bond0.100"]["parent"], "bond0")
+        self.assertIsNone(links["vhost0"]["kind"])
+        self.assertEqual(links["vhost0"]["mac"], "52:54:00:6a:11:01")
+        self.assertEqual(links["vhost0"]["mtu"], 9000)
+
+    def test_addrs_and_routes(self):
+        self.assertEqual(self.state["links"]["vhost0"]["addrs"],
+                         [{"addr": "10.0.0.5", "prefixlen": 24}])
+        self.assertEqual(
+            [(r["dst"], r["dst_len"], r["gateway"], r["dev"])
+             for r in self.state["routes"]],
+            [("0.0.0.0", 0, "10.0.0.1", "vhost0"),
+             ("10.0.0.0", 24, None, "vhost0")])
+
+
+class TestGetVhostPhys(unittest.TestCase):
+
+    def _get_vhost_phys(self, name):
+        with mock.patch.object(network_utils, "get_network_state",
+                               return_value=load_state(name)):
+            return network_utils.get_vhost_phys("vhost0")
+
+    def test_nic(self):
+        self.assertEqual(self._get_vhost_phys("ip-link-nic.json"), "ens3")
+
+    def test_bond(self):
+        self.assertEqual(self._get_vhost_phys("ip-link-bond.json"), "bond0")
+
+    def test_vlan(self):
+        self.assertEqual(self._get_vhost_phys("ip-link-vlan.json"),
+                         "ens3.100")
+
+    def test_vlan_on_bond(self):
+        with open(os.path.join(DATA_DIR, "netlink-bond-vlan.json")) as f:
+            dump = json.load(f)
+        state = network_utils.parse_netlink(
+            dump["links"], dump["addrs"], dump["routes"])
+        with mock.patch.object(network_utils, "get_network_state",
+                               return_value=state):
+            self.assertEqual(network_utils.get_vhost_phys("vhost0"),
+                             "bond0.100")
+
+    def test_no_vhost(self):
+        with mock.patch.object(network_utils, "get_network_state",
+                               return_value={"links": {}, "routes": []}):
+            self.assertIsNone(network_utils.get_vhost_phys("vhost0"))
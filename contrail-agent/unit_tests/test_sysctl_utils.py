@@ -0,0 +1,35 @@
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# module reads charm config on import
+with mock.patch("charmhelpers.core.hookenv.config"):
+    import sysctl_utils
+
+
+class TestSysctlPath(unittest.TestCase):
+
+    def test_global_key(self):
+        self.assertEqual(sysctl_utils.sysctl_path("net.core.somaxconn"),
+                         "net/core/somaxconn")
+
+    def test_interface_key(self):
+        self.assertEqual(
+            sysctl_utils.sysctl_path("net.ipv4.conf.eth0.rp_filter"),
+            "net/ipv4/conf/eth0/rp_filter")
+
+    def test_vlan_interface_key(self):
+        self.assertEqual(
+            sysctl_utils.sysctl_path("net.ipv4.conf.eth0.100.rp_filter"),
+            "net/ipv4/conf/eth0.100/rp_filter")
+        self.assertEqual(
+            sysctl_utils.sysctl_path("net.ipv6.neigh.bond0.200.gc_stale_time"),
+            "net/ipv6/neigh/bond0.200/gc_stale_time")
+
+    def test_path_key(self):
+        self.assertEqual(
+            sysctl_utils.sysctl_path("net/ipv4/conf/eth0.100/rp_filter"),
+            "net/ipv4/conf/eth0.100/rp_filter")
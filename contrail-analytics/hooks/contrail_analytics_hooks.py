@@ -13,6 +13,7 @@ from charmhelpers.core.hookenv import (
     status_set,
     relation_set,
     local_unit,
+    is_leader,
 )
 
 from charmhelpers.fetch import (
@@ -23,9 +24,13 @@ from charmhelpers.fetch import (
 
 from contrail_analytics_utils import (
     update_charm_status,
+    upgrade_container,
+    CLUSTER_NAME,
     CONTAINER_NAME,
 )
 from common_utils import (
+    grant_upgrade_lease,
+    request_upgrade,
     get_ip,
     fix_hostname,
 )
@@ -33,6 +38,7 @@ from docker_utils import (
     add_docker_repo,
     DOCKER_PACKAGES,
     is_container_launched,
+    update_container_resources,
 )
 
 
@@ -67,6 +73,7 @@ def config_changed():
             for rid in relation_ids(rname):
                 relation_set(relation_id=rid, relation_settings=settings)
 
+    update_container_resources(CONTAINER_NAME)
     update_charm_status()
 
 
@@ -104,6 +111,7 @@ def contrail_analytics_changed():
     changed |= _value_changed(data, "rabbitmq_user", "rabbitmq_user")
     changed |= _value_changed(data, "rabbitmq_password", "rabbitmq_password")
     changed |= _value_changed(data, "rabbitmq_vhost", "rabbitmq_vhost")
+    changed |= _value_changed(data, "rabbitmq-servers", "rabbitmq_servers")
     # TODO: handle changing of all values
     # TODO: set error if orchestrator is changing and container was started
     if changed:
@@ -117,7 +125,8 @@ def contrail_analytics_departed():
     if not units:
         for key in ["auth_info", "auth_mode", "orchestrator_info",
                     "ssl_ca", "ssl_cert", "ssl_key", "rabbitmq_vhost",
-                    "rabbitmq_user", "rabbitmq_password"]:
+                    "rabbitmq_user", "rabbitmq_password",
+                    "rabbitmq_servers"]:
             config.pop(key, None)
         if is_container_launched(CONTAINER_NAME):
             status_set(
@@ -161,16 +170,20 @@ def analytics_cluster_joined():
 
 @hooks.hook("update-status")
 def update_status():
+    upgrade_container()
     update_charm_status(update_config=False)
 
 
 @hooks.hook("upgrade-charm")
 def upgrade_charm():
-    # NOTE: image can not be deleted if container is running.
-    # TODO: so think about killing the container
-
     # NOTE: this hook can be fired when either resource changed or charm code
-    # changed. so if code was changed then we may need to update config
+    # changed. new image is loaded beside running container and container is
+    # replaced when leader gives the lease to this unit.
+    if request_upgrade(CLUSTER_NAME, CONTAINER_NAME):
+        upgrade_container()
+        return
+
+    # code was changed so we may need to update config
     update_charm_status()
 
 
@@ -190,6 +203,19 @@ def http_services_joined():
     relation_set(services=yaml.dump(_http_services()))
 
 
+@hooks.hook("analytics-cluster-relation-changed",
+            "analytics-cluster-relation-departed", "leader-elected")
+def analytics_cluster_changed():
+    if is_leader():
+        grant_upgrade_lease(CLUSTER_NAME)
+        upgrade_container()
+
+
+@hooks.hook("leader-settings-changed")
+def leader_settings_changed():
+    upgrade_container()
+
+
 def main():
     try:
         hooks.execute(sys.argv)
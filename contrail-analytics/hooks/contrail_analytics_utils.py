@@ -20,6 +20,8 @@ from common_utils import (
     check_run_prerequisites,
     run_container,
     json_loads,
+    upgrade_if_leased,
+    get_performance_settings,
 )
 
 apt_pkg.init()
@@ -29,6 +31,7 @@ config = config()
 CONTAINER_NAME = "contrail-analytics"
 CONFIG_NAME = "analytics"
 SERVICES_TO_CHECK = ["contrail-collector", "contrail-analytics-api"]
+CLUSTER_NAME = "analytics-cluster"
 
 
 def controller_ctx():
@@ -79,6 +82,13 @@ def analyticsdb_ctx():
     return {"analyticsdb_servers": analyticsdb_ip_list}
 
 
+def _profile_settings(profile, cores, ram):
+    return {
+        "uve_partition_count": {"small": 15, "medium": 30,
+                                "large": 60}[profile],
+    }
+
+
 def get_context():
     ctx = {}
     ctx.update(json_loads(config.get("orchestrator_info"), dict()))
@@ -95,10 +105,13 @@ def get_context():
     ctx["rabbitmq_user"] = config.get("rabbitmq_user")
     ctx["rabbitmq_password"] = config.get("rabbitmq_password")
     ctx["rabbitmq_vhost"] = config.get("rabbitmq_vhost")
+    ctx["rabbitmq_servers"] = json_loads(config.get("rabbitmq_servers"),
+                                         list())
 
     ctx.update(controller_ctx())
     ctx.update(analytics_ctx())
     ctx.update(analyticsdb_ctx())
+    ctx.update(get_performance_settings(_profile_settings))
     ctx.update(json_loads(config.get("auth_info"), dict()))
     return ctx
 
@@ -161,3 +174,8 @@ def update_charm_status(update_config=True):
     open_port(8081, "TCP")
 
     run_container(CONTAINER_NAME, "contrail-analytics")
+
+
+def upgrade_container():
+    upgrade_if_leased(CLUSTER_NAME, CONTAINER_NAME, "contrail-analytics",
+                      SERVICES_TO_CHECK)
@@ -1,25 +1,33 @@
 from base64 import b64decode
+from multiprocessing import cpu_count
 import os
 from socket import gethostbyname, gethostname, gaierror
 from subprocess import (
     CalledProcessError,
     check_call,
-    check_output
 )
-import netifaces
 import time
 import platform
 import json
+import yaml
 
 from charmhelpers.contrib.network.ip import get_address_in_network
 from charmhelpers.core.hookenv import (
     config,
+    is_leader,
+    leader_get,
+    leader_set,
+    local_unit,
+    related_units,
+    relation_get,
+    relation_ids,
+    relation_set,
     status_set,
     log,
     ERROR,
     application_version_set,
 )
-from charmhelpers.core.host import write_file
+from charmhelpers.core.host import get_total_ram, write_file
 
 from docker_utils import (
     is_container_launched,
@@ -30,10 +38,31 @@ from docker_utils import (
     launch_docker_image,
     dpkg_version,
     docker_exec,
+    get_container_image_id,
+    get_image_id,
+    get_resource_hash,
+    remove_container,
+    remove_image,
+    rename_container,
+    start_container,
+    stop_container,
+    wait_container_exec,
+)
+from network_utils import (
+    get_default_iface,
+    get_iface_addr,
 )
 
 config = config()
 
+PERFORMANCE_PROFILES = ("default", "small", "medium", "large")
+
+# time to wait for services of upgraded container before rollback, they
+# are checked by next hooks including update-status
+UPGRADE_TIMEOUT = 600
+# suffix of previous container that is kept until upgrade is finished
+PREVIOUS_SUFFIX = "-previous"
+
 
 def get_ip():
     network = config.get("control-network")
@@ -44,12 +73,12 @@ def get_ip():
 
 
 def _get_default_ip():
-    if hasattr(netifaces, "gateways"):
-        iface = netifaces.gateways()["default"][netifaces.AF_INET][1]
-    else:
-        data = check_output("ip route | grep ^default", shell=True).split()
-        iface = data[data.index("dev") + 1]
-    return netifaces.ifaddresses(iface)[netifaces.AF_INET][0]["addr"]
+    iface = get_default_iface()
+    addr = get_iface_addr(iface) if iface else None
+    if not addr:
+        raise Exception("Couldn't find IP address of interface with default "
+                        "route, 'control-network' must be set")
+    return addr["addr"]
 
 
 def fix_hostname():
@@ -91,7 +120,7 @@ def update_services_status(name, services):
     except CalledProcessError as e:
         log("Container is not ready to get contrail-status: " + str(e))
         status_set("waiting", "Waiting services to run in container")
-        return
+        return False
 
     statuses = dict()
     for line in output.splitlines()[1:]:
@@ -105,15 +134,20 @@ def update_services_status(name, services):
     for srv in services:
         if srv not in statuses:
             status_set("waiting", srv + " is absent in the contrail-status")
-            return
+            return False
         status, desc = statuses.get(srv)
         if status != "active":
             workload = "waiting" if status == "initializing" else "blocked"
             status_set(workload, "{} is not ready. Reason: {}"
                        .format(srv, desc))
-            return
+            return False
 
+    if config.get("failed-image-hash"):
+        status_set("blocked", "Upgrade is rolled back, new image is not "
+                   "healthy")
+        return True
     status_set("active", "Unit is ready")
+    return True
 
 
 def check_run_prerequisites(name, config_name, update_config_func, services):
@@ -138,17 +172,25 @@ def check_run_prerequisites(name, config_name, update_config_func, services):
         if not image_id:
             status_set("waiting", "Awaiting for container resource")
             return False
+        config["image-hash"] = get_resource_hash(name)
 
     return True
 
 
-def run_container(name, pkg_to_check):
+def _get_run_args():
     args = []
     if platform.linux_distribution()[2].strip() == "trusty":
         args.append("--pid=host")
-    launch_docker_image(name, args)
+    return args
+
+
+def run_container(name, pkg_to_check, image_id=None, additional_args=[]):
+    launch_docker_image(name, _get_run_args() + additional_args, image_id)
 
-    time.sleep(5)
+    try:
+        wait_container_exec(name)
+    except CalledProcessError as e:
+        log("Container is not ready to exec commands: " + str(e))
     version = dpkg_version(name, pkg_to_check)
     application_version_set(version)
     status_set("waiting", "Waiting services to run in container")
@@ -156,3 +198,230 @@ def run_container(name, pkg_to_check):
 
 def json_loads(data, default=None):
     return json.loads(data) if data else default
+
+
+def get_performance_settings(profile_settings):
+    """Returns settings of 'performance-profile' sized for this host.
+
+    profile_settings(profile, cores, ram) returns settings of the profile
+    for given number of cores and RAM in megabytes. 'default' profile has
+    no settings, so config is rendered as before profiles. 'custom' profile
+    takes only settings from YAML dictionary of 'performance-settings'
+    that are validated against 'medium'.
+    """
+    profile = config.get("performance-profile")
+    if profile not in PERFORMANCE_PROFILES + ("custom",):
+        raise Exception("performance-profile must be one of: "
+                        + ", ".join(PERFORMANCE_PROFILES + ("custom",)))
+    if profile == "default":
+        return {}
+    ram = get_total_ram() // 1024 ** 2
+    settings = profile_settings(
+        "medium" if profile == "custom" else profile, cpu_count(), ram)
+    if profile != "custom":
+        return settings
+
+    try:
+        overrides = yaml.safe_load(
+            config.get("performance-settings") or "{}") or {}
+    except yaml.YAMLError:
+        overrides = None
+    if not isinstance(overrides, dict):
+        raise Exception("performance-settings must be a YAML dictionary")
+    for key, value in overrides.items():
+        if key not in settings:
+            raise Exception("Unknown performance setting: " + key)
+        if type(value) is not type(settings[key]):
+            raise Exception("Performance setting {} must be {}".format(
+                key, type(settings[key]).__name__))
+    return overrides
+
+
+def _unit_number(unit):
+    return int(unit.split("/")[-1])
+
+
+def request_upgrade(cluster, name):
+    """Pre-loads new image of running container and asks leader for the
+    upgrade lease.
+
+    Returns False if container doesn't need to be upgraded.
+    """
+    if config.get("upgrade-deadline"):
+        # upgrade is in progress, resource is checked again after it
+        return True
+    image_hash = get_resource_hash(name)
+    if not image_hash or not is_container_present(name):
+        return False
+    if not config.get("image-hash"):
+        # container was started by previous version of charm that didn't
+        # track images, it's assumed to run current resource
+        config["image-hash"] = image_hash
+    if image_hash == config.get("image-hash"):
+        if (config.get("upgrade-image-hash")
+                or config.get("failed-image-hash")):
+            # resource was reverted to the running image
+            _cancel_upgrade(cluster)
+        return False
+    if image_hash == config.get("failed-image-hash"):
+        # rolled back already, lease is kept until another image is given
+        return True
+    if image_hash != config.get("upgrade-image-hash"):
+        if config.get("upgrade-image-id"):
+            remove_image(config.pop("upgrade-image-id"))
+        config.pop("failed-image-hash", None)
+        status_set("maintenance", "Loading new image")
+        image_id = load_docker_image(name, keep_previous=True)
+        # image is verified before the lease is asked for, so the swap
+        # doesn't depend on the load
+        if not image_id or not get_image_id(image_id):
+            status_set("blocked", "New image can't be loaded")
+            return True
+        if image_id == get_container_image_id(name):
+            log("Resource has the image of running container")
+            config["image-hash"] = image_hash
+            return False
+        config["upgrade-image-hash"] = image_hash
+        config["upgrade-image-id"] = image_id
+
+    status_set("maintenance", "Waiting for upgrade lease")
+    for rid in relation_ids(cluster):
+        relation_set(relation_id=rid, relation_settings={
+            "upgrade-request": image_hash})
+    if is_leader():
+        grant_upgrade_lease(cluster)
+    return True
+
+
+def _cancel_upgrade(cluster):
+    if config.get("upgrade-image-id"):
+        remove_image(config.pop("upgrade-image-id"))
+    config.pop("upgrade-image-hash", None)
+    config.pop("failed-image-hash", None)
+    for rid in relation_ids(cluster):
+        relation_set(relation_id=rid, relation_settings={
+            "upgrade-request": None})
+    if is_leader():
+        grant_upgrade_lease(cluster)
+
+
+def grant_upgrade_lease(cluster):
+    """Gives upgrade lease to the next unit that requested it.
+
+    Only one unit holds the lease, so only one container of application is
+    being replaced at any time. Lease is released when holder clears its
+    request or leaves the cluster.
+    """
+    requests = dict()
+    image_hash = (config.get("upgrade-image-hash")
+                  or config.get("failed-image-hash"))
+    if image_hash:
+        requests[local_unit()] = image_hash
+    for rid in relation_ids(cluster):
+        for unit in related_units(rid):
+            if relation_get("upgrade-request", unit, rid):
+                requests[unit] = relation_get("upgrade-request", unit, rid)
+
+    lease = leader_get("upgrade_lease")
+    if lease in requests:
+        return
+    lease = min(requests, key=_unit_number) if requests else ""
+    if lease != leader_get("upgrade_lease"):
+        log("Upgrade lease is given to " + (lease or "nobody"))
+        leader_set(upgrade_lease=lease)
+
+
+def _swap_container(name, image_id, additional_args):
+    # readiness of new container is checked later by the upgrade check
+    previous = name + PREVIOUS_SUFFIX
+    if is_container_present(previous):
+        # left by interrupted upgrade
+        remove_container(previous)
+    stop_container(name)
+    rename_container(name, previous)
+    launch_docker_image(name, _get_run_args() + additional_args, image_id)
+
+
+def _rollback_container(name):
+    previous = name + PREVIOUS_SUFFIX
+    if is_container_present(previous):
+        if is_container_present(name):
+            remove_container(name)
+        rename_container(previous, name)
+    start_container(name)
+    if config.get("upgrade-old-version"):
+        application_version_set(config["upgrade-old-version"])
+
+
+def upgrade_if_leased(cluster, name, pkg_to_check, services,
+                      additional_args=[]):
+    """Replaces container with the pre-loaded image if this unit holds the
+    lease.
+
+    Hook isn't blocked while services of the new container start: deadline
+    is kept in charm state and services are checked by next hooks. Previous
+    container is stopped and kept until services of the new one are
+    healthy. Otherwise it's started back after the deadline and the lease
+    is kept, so the rest of units stay on the working image.
+    """
+    if config.get("upgrade-deadline"):
+        _check_upgraded_container(cluster, name, pkg_to_check, services)
+        return
+    if (leader_get("upgrade_lease") != local_unit()
+            or not config.get("upgrade-image-hash")):
+        return
+
+    status_set("maintenance", "Replacing container with new image")
+    config["upgrade-start"] = time.time()
+    config["upgrade-deadline"] = time.time() + UPGRADE_TIMEOUT
+    config["upgrade-old-image-id"] = get_container_image_id(name)
+    config["upgrade-old-version"] = dpkg_version(name, pkg_to_check)
+    try:
+        _swap_container(name, config.get("upgrade-image-id"),
+                        additional_args)
+    except CalledProcessError as e:
+        log("Container can't be replaced: " + str(e), level=ERROR)
+        # roll back right away
+        config["upgrade-deadline"] = time.time()
+    _check_upgraded_container(cluster, name, pkg_to_check, services)
+
+
+def _check_upgraded_container(cluster, name, pkg_to_check, services):
+    healthy = (is_container_launched(name)
+               and update_services_status(name, services))
+    elapsed = int(time.time() - config["upgrade-start"])
+    if not healthy and time.time() < config["upgrade-deadline"]:
+        status_set("maintenance", "Waiting for services of upgraded "
+                   "container")
+        return
+
+    old_image_id = config.pop("upgrade-old-image-id")
+    config.pop("upgrade-start")
+    config.pop("upgrade-deadline")
+    if not healthy:
+        log("Services are not healthy after upgrade in {}s, container is "
+            "rolled back and lease is kept".format(elapsed), level=ERROR)
+        _rollback_container(name)
+        config.pop("upgrade-old-version", None)
+        image_id = config.pop("upgrade-image-id", None)
+        if image_id:
+            remove_image(image_id)
+        config["failed-image-hash"] = config.pop("upgrade-image-hash")
+        status_set("blocked", "Upgrade is rolled back, new image is not "
+                   "healthy")
+        return
+
+    config.pop("upgrade-old-version", None)
+    application_version_set(dpkg_version(name, pkg_to_check))
+    remove_container(name + PREVIOUS_SUFFIX)
+    remove_image(old_image_id)
+    config["image-hash"] = config.pop("upgrade-image-hash")
+    config.pop("upgrade-image-id", None)
+    log("Container was upgraded in {}s".format(elapsed))
+    for rid in relation_ids(cluster):
+        relation_set(relation_id=rid, relation_settings={
+            "upgrade-request": None, "upgrade-time": elapsed})
+    status_set("active", "Unit is ready, upgraded in {}s".format(elapsed))
+    # resource could be changed again while upgrade was in progress
+    if not request_upgrade(cluster, name) and is_leader():
+        grant_upgrade_lease(cluster)
@@ -27,9 +27,13 @@ from charmhelpers.fetch import (
 
 from contrail_analyticsdb_utils import (
     update_charm_status,
+    upgrade_container,
+    CLUSTER_NAME,
     CONTAINER_NAME,
 )
 from common_utils import (
+    grant_upgrade_lease,
+    request_upgrade,
     get_ip,
     fix_hostname,
 )
@@ -37,6 +41,7 @@ from docker_utils import (
     add_docker_repo,
     DOCKER_PACKAGES,
     is_container_launched,
+    update_container_resources,
 )
 
 
@@ -70,10 +75,13 @@ def leader_elected():
         leader_set(db_user=user, db_password=password)
         _update_relation()
     update_charm_status()
+    grant_upgrade_lease(CLUSTER_NAME)
+    upgrade_container()
 
 
 @hooks.hook("leader-settings-changed")
 def leader_settings_changed():
+    upgrade_container()
     update_charm_status()
 
 
@@ -86,6 +94,7 @@ def config_changed():
             for rid in relation_ids(rname):
                 relation_set(relation_id=rid, relation_settings=settings)
 
+    update_container_resources(CONTAINER_NAME)
     update_charm_status()
 
 
@@ -165,19 +174,31 @@ def analyticsdb_cluster_joined():
 
 @hooks.hook("update-status")
 def update_status():
+    upgrade_container()
     update_charm_status(update_config=False)
 
 
 @hooks.hook("upgrade-charm")
 def upgrade_charm():
-    # NOTE: image can not be deleted if container is running.
-    # TODO: so think about killing the container
-
     # NOTE: this hook can be fired when either resource changed or charm code
-    # changed. so if code was changed then we may need to update config
+    # changed. new image is loaded beside running container and container is
+    # replaced when leader gives the lease to this unit.
+    if request_upgrade(CLUSTER_NAME, CONTAINER_NAME):
+        upgrade_container()
+        return
+
+    # code was changed so we may need to update config
     update_charm_status()
 
 
+@hooks.hook("analyticsdb-cluster-relation-changed",
+            "analyticsdb-cluster-relation-departed")
+def analyticsdb_cluster_changed():
+    if is_leader():
+        grant_upgrade_lease(CLUSTER_NAME)
+        upgrade_container()
+
+
 def main():
     try:
         hooks.execute(sys.argv)
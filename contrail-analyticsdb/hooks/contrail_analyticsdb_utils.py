@@ -20,6 +20,8 @@ from common_utils import (
     check_run_prerequisites,
     run_container,
     json_loads,
+    upgrade_if_leased,
+    get_performance_settings,
 )
 
 
@@ -30,6 +32,7 @@ config = config()
 CONTAINER_NAME = "contrail-analyticsdb"
 CONFIG_NAME = "analyticsdb"
 SERVICES_TO_CHECK = ["contrail-database"]
+CLUSTER_NAME = "analyticsdb-cluster"
 
 
 def servers_ctx():
@@ -64,6 +67,16 @@ def analyticsdb_ctx():
     return {"analyticsdb_servers": analyticsdb_ip_list}
 
 
+def _profile_settings(profile, cores, ram):
+    # 'medium' sizes heap like cassandra-env.sh does
+    heap_limit = {"small": 2048, "medium": 8192, "large": 16384}[profile]
+    heap = max(min(ram // 2, 1024), min(ram // 4, heap_limit))
+    return {
+        "cassandra_heap_size": "{}M".format(heap),
+        "cassandra_heap_newsize": "{}M".format(min(100 * cores, heap // 4)),
+    }
+
+
 def get_context():
     ctx = {}
     ctx.update(json_loads(config.get("orchestrator_info"), dict()))
@@ -79,6 +92,7 @@ def get_context():
 
     ctx.update(servers_ctx())
     ctx.update(analyticsdb_ctx())
+    ctx.update(get_performance_settings(_profile_settings))
     ctx.update(json_loads(config.get("auth_info"), dict()))
     return ctx
 
@@ -132,3 +146,8 @@ def update_charm_status(update_config=True):
 
     render_config(ctx)
     run_container(CONTAINER_NAME, "contrail-nodemgr")
+
+
+def upgrade_container():
+    upgrade_if_leased(CLUSTER_NAME, CONTAINER_NAME, "contrail-nodemgr",
+                      SERVICES_TO_CHECK)
@@ -0,0 +1,257 @@
+"""Introspection of host network: links, IPv4 addresses and routes.
+
+Network state is read once per hook through netlink (pyroute2), JSON output
+of iproute2 or, if both are not available, from /sys/class/net,
+/proc/net/route and netifaces. All lookups are served from this snapshot.
+"""
+
+import json
+import os
+import socket
+import struct
+from subprocess import (
+    CalledProcessError,
+    check_output,
+)
+
+import netifaces
+
+from charmhelpers.core.hookenv import (
+    cached,
+    log,
+    WARNING,
+)
+
+try:
+    from pyroute2 import IPRoute
+except ImportError:
+    IPRoute = None
+
+
+SYS_NET = "/sys/class/net"
+PROC_ROUTE = "/proc/net/route"
+RT_TABLE_MAIN = 254
+RTF_GATEWAY = 0x2
+
+
+def _attr(msg, name, default=None):
+    for attr in msg.get("attrs", []):
+        if attr[0] == name:
+            return attr[1]
+    return default
+
+
+def _prefixlen(netmask):
+    return bin(struct.unpack("!L", socket.inet_aton(netmask))[0]).count("1")
+
+
+def parse_netlink(links, addrs, routes):
+    """Builds network state from netlink dumps.
+
+    Dumps are lists of RTM_NEWLINK, RTM_NEWADDR and RTM_NEWROUTE messages as
+    they are returned by pyroute2 or loaded from recorded JSON.
+    """
+    names = dict()
+    state = {"links": dict(), "routes": list()}
+    for msg in links:
+        name = _attr(msg, "IFLA_IFNAME")
+        names[msg["index"]] = name
+        info = _attr(msg, "IFLA_LINKINFO") or {}
+        kind = _attr(info, "IFLA_INFO_KIND")
+        state["links"][name] = {
+            "mac": _attr(msg, "IFLA_ADDRESS"),
+            "mtu": _attr(msg, "IFLA_MTU"),
+            "master": _attr(msg, "IFLA_MASTER"),
+            "kind": kind,
+            # lower device of VLAN
+            "parent": _attr(msg, "IFLA_LINK") if kind == "vlan" else None,
+            "addrs": list(),
+        }
+    for link in state["links"].values():
+        link["master"] = names.get(link["master"])
+        link["parent"] = names.get(link["parent"])
+
+    for msg in addrs:
+        link = state["links"].get(names.get(msg["index"]))
+        if msg["family"] != socket.AF_INET or link is None:
+            continue
+        addr = _attr(msg, "IFA_LOCAL") or _attr(msg, "IFA_ADDRESS")
+        link["addrs"].append({"addr": addr, "prefixlen": msg["prefixlen"]})
+
+    for msg in routes:
+        if msg["family"] != socket.AF_INET:
+            continue
+        if _attr(msg, "RTA_TABLE", msg.get("table")) != RT_TABLE_MAIN:
+            continue
+        state["routes"].append({
+            "dst": _attr(msg, "RTA_DST", "0.0.0.0"),
+            "dst_len": msg["dst_len"],
+            "gateway": _attr(msg, "RTA_GATEWAY"),
+            "dev": names.get(_attr(msg, "RTA_OIF")),
+        })
+    return state
+
+
+def parse_iproute2(links, routes):
+    """Builds network state from JSON output of iproute2.
+
+    links is output of 'ip -d -j addr show' (or of 'ip -d -j link show' that
+    has no addresses) and routes is output of 'ip -j route show table main'.
+    """
+    state = {"links": dict(), "routes": list()}
+    for link in links:
+        info = link.get("linkinfo") or {}
+        kind = info.get("info_kind")
+        state["links"][link["ifname"]] = {
+            "mac": link.get("address"),
+            "mtu": link.get("mtu"),
+            "master": link.get("master"),
+            "kind": kind,
+            "parent": link.get("link") if kind == "vlan" else None,
+            "addrs": [{"addr": addr["local"], "prefixlen": addr["prefixlen"]}
+                      for addr in link.get("addr_info", [])
+                      if addr.get("family") == "inet"],
+        }
+
+    for route in routes:
+        dst = route.get("dst", "default")
+        if dst == "default":
+            dst = "0.0.0.0/0"
+        elif "/" not in dst:
+            dst += "/32"
+        dst, dst_len = dst.split("/")
+        state["routes"].append({
+            "dst": dst,
+            "dst_len": int(dst_len),
+            "gateway": route.get("gateway"),
+            "dev": route.get("dev"),
+        })
+    return state
+
+
+def _read_ip_json(args):
+    try:
+        output = check_output(["ip", "-j"] + args)
+        return json.loads(output.decode("UTF-8"))
+    except (OSError, CalledProcessError, ValueError):
+        # iproute2 before 4.13 doesn't support JSON output
+        return None
+
+
+def _read_attr(path, attr):
+    try:
+        with open(os.path.join(path, attr)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _hex_to_ip(value):
+    return socket.inet_ntoa(struct.pack("<L", int(value, 16)))
+
+
+def parse_sysfs(sys_net=SYS_NET, proc_route=PROC_ROUTE):
+    """Builds network state from /sys, /proc and netifaces."""
+    state = {"links": dict(), "routes": list()}
+    for name in os.listdir(sys_net):
+        path = os.path.join(sys_net, name)
+        kind = None
+        parent = None
+        if os.path.isdir(os.path.join(path, "bonding")):
+            kind = "bond"
+        elif os.path.isdir(os.path.join(path, "bridge")):
+            kind = "bridge"
+        elif "DEVTYPE=vlan" in (_read_attr(path, "uevent") or ""):
+            kind = "vlan"
+            lower = [entry for entry in os.listdir(path)
+                     if entry.startswith("lower_")]
+            parent = lower[0][len("lower_"):] if lower else None
+        master = os.path.join(path, "master")
+        master = (os.path.basename(os.path.realpath(master))
+                  if os.path.exists(master) else None)
+        mtu = _read_attr(path, "mtu")
+        try:
+            ifaddrs = netifaces.ifaddresses(name).get(netifaces.AF_INET, [])
+        except ValueError:
+            ifaddrs = []
+        state["links"][name] = {
+            "mac": _read_attr(path, "address"),
+            "mtu": int(mtu) if mtu else None,
+            "master": master,
+            "kind": kind,
+            "parent": parent,
+            "addrs": [{"addr": addr["addr"],
+                       "prefixlen": _prefixlen(addr["netmask"])}
+                      for addr in ifaddrs],
+        }
+
+    with open(proc_route) as f:
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+            flags = int(fields[3], 16)
+            state["routes"].append({
+                "dst": _hex_to_ip(fields[1]),
+                "dst_len": _prefixlen(_hex_to_ip(fields[7])),
+                "gateway": (_hex_to_ip(fields[2])
+                            if flags & RTF_GATEWAY else None),
+                "dev": fields[0],
+            })
+    return state
+
+
+@cached
+def get_network_state():
+    if IPRoute:
+        try:
+            ipr = IPRoute()
+            try:
+                return parse_netlink(
+                    ipr.get_links(),
+                    ipr.get_addr(family=socket.AF_INET),
+                    ipr.get_routes(family=socket.AF_INET))
+            finally:
+                ipr.close()
+        except Exception as e:
+            log("Couldn't read network state via netlink: " + str(e),
+                level=WARNING)
+    links = _read_ip_json(["-d", "addr", "show"])
+    routes = _read_ip_json(["route", "show", "table", "main"])
+    if links is not None and routes is not None:
+        return parse_iproute2(links, routes)
+    return parse_sysfs()
+
+
+def get_link(name):
+    return get_network_state()["links"].get(name)
+
+
+def get_iface_addr(name):
+    """Returns first IPv4 address of interface as dict with keys 'addr' and
+    'prefixlen' or None if interface doesn't have addresses.
+    """
+    link = get_link(name)
+    return link["addrs"][0] if link and link["addrs"] else None
+
+
+def get_default_iface():
+    for route in get_network_state()["routes"]:
+        if route["dst_len"] == 0:
+            return route["dev"]
+    return None
+
+
+def get_gateway(iface):
+    """Returns gateway for interface preferring the default route."""
+    routes = [route for route in get_network_state()["routes"]
+              if route["gateway"] and route["dev"] == iface]
+    routes.sort(key=lambda route: route["dst_len"])
+    return routes[0]["gateway"] if routes else None
+
+
+def get_slaves(name):
+    """Returns members of bond or ports of bridge."""
+    links = get_network_state()["links"]
+    return sorted(iface for iface, link in links.items()
+                  if link["master"] == name)
@@ -0,0 +1,213 @@
+"""Client for Contrail API that provisions virtual-router objects and
+global vrouter settings.
+
+One HTTP session is used for all requests of a hook and keystone token is
+kept in a file readable by root only and reused until it is close to the
+expiration reported by keystone.
+"""
+
+import calendar
+import json
+import os
+from time import strptime, time
+
+import requests
+
+from charmhelpers.core.hookenv import (
+    cached,
+    charm_dir,
+    config,
+    log,
+)
+from charmhelpers.core.host import write_file
+
+config = config()
+
+
+GLOBAL_SYSTEM_CONFIG = "default-global-system-config"
+GLOBAL_VROUTER_CONFIG = "default-global-vrouter-config"
+REQUEST_TIMEOUT = 10
+TOKEN_FILE = ".api-token"
+# token is renewed this number of seconds before its expiration
+TOKEN_EXPIRY_MARGIN = 300
+
+
+@cached
+def _get_session():
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+
+def _parse_expiry(value):
+    # keystone returns UTC time like 2017-06-01T12:00:00.000000Z
+    try:
+        return calendar.timegm(strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+    except (TypeError, ValueError):
+        log("Couldn't parse token expiration: {}".format(value))
+        return 0
+
+
+def _get_token_file():
+    return os.path.join(charm_dir(), TOKEN_FILE)
+
+
+def _load_token():
+    # tokens were kept in charm config by previous versions
+    config.pop("api_token", None)
+    config.pop("api_token_expires", None)
+    try:
+        with open(_get_token_file()) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if time() < data.get("expires", 0) - TOKEN_EXPIRY_MARGIN:
+        return data.get("token")
+    return None
+
+
+def _save_token(token, expires):
+    write_file(_get_token_file(),
+               json.dumps({"token": token, "expires": expires}),
+               perms=0o600)
+
+
+def _get_token(auth_info, renew=False):
+    if not auth_info.get("keystone_admin_user"):
+        # API is accessible without authentication
+        return None
+    token = _load_token() if not renew else None
+    if token:
+        return token
+
+    user = auth_info["keystone_admin_user"]
+    password = auth_info["keystone_admin_password"]
+    tenant = auth_info["keystone_admin_tenant"]
+    api_ver = int(auth_info["keystone_api_version"])
+    if api_ver == 2:
+        req_data = {
+            "auth": {
+                "tenantName": tenant,
+                "passwordCredentials": {
+                    "username": user,
+                    "password": password}}}
+    else:
+        domain = {"name": auth_info.get("keystone_user_domain_name")
+                  or "default"}
+        project_domain = {
+            "name": auth_info.get("keystone_project_domain_name")
+            or "default"}
+        req_data = {
+            "auth": {
+                "identity": {
+                    "methods": ["password"],
+                    "password": {
+                        "user": {
+                            "name": user,
+                            "domain": domain,
+                            "password": password
+                        }
+                    }
+                },
+                "scope": {
+                    "project": {
+                        "name": (auth_info.get("keystone_project_name")
+                                 or tenant),
+                        "domain": project_domain
+                    }
+                }
+            }
+        }
+
+    url = "{proto}://{ip}:{port}/{tokens}".format(
+        proto=auth_info["keystone_protocol"],
+        ip=auth_info["keystone_ip"],
+        port=auth_info["keystone_public_port"],
+        tokens=auth_info["keystone_api_tokens"])
+    r = _get_session().post(url, data=json.dumps(req_data), verify=False,
+                            timeout=REQUEST_TIMEOUT)
+    r.raise_for_status()
+    if api_ver == 2:
+        token = r.json()["access"]["token"]["id"]
+        expires = r.json()["access"]["token"].get("expires")
+    else:
+        token = r.headers["X-Subject-Token"]
+        expires = r.json()["token"].get("expires_at")
+
+    _save_token(token, _parse_expiry(expires))
+    return token
+
+
+def _request(method, api, auth_info, path, data=None, allow_missing=False):
+    url = "http://{}:{}{}".format(api[0], api[1], path)
+    body = json.dumps(data) if data is not None else None
+
+    def _send(token):
+        headers = {"X-Auth-Token": token} if token else {}
+        return _get_session().request(method, url, data=body,
+                                      headers=headers,
+                                      timeout=REQUEST_TIMEOUT)
+
+    r = _send(_get_token(auth_info))
+    if r.status_code == 401:
+        # cached token is expired or revoked
+        r = _send(_get_token(auth_info, renew=True))
+    if r.status_code == 404 and allow_missing:
+        return None
+    r.raise_for_status()
+    return r.json() if r.content else {}
+
+
+def _get_virtual_router_id(api, auth_info, name):
+    data = {"type": "virtual-router",
+            "fq_name": [GLOBAL_SYSTEM_CONFIG, name]}
+    result = _request("POST", api, auth_info, "/fqname-to-id", data,
+                      allow_missing=True)
+    return result["uuid"] if result else None
+
+
+def ensure_virtual_router(api, auth_info, name, ip):
+    """Creates or updates virtual-router object.
+
+    Nothing is sent to API if object already exists with the same address.
+    """
+    uuid = _get_virtual_router_id(api, auth_info, name)
+    if not uuid:
+        data = {"virtual-router": {
+            "parent_type": "global-system-config",
+            "fq_name": [GLOBAL_SYSTEM_CONFIG, name],
+            "virtual_router_ip_address": ip}}
+        _request("POST", api, auth_info, "/virtual-routers", data)
+        log("virtual-router {} was created with address {}".format(name, ip))
+        return
+
+    path = "/virtual-router/" + uuid
+    vrouter = _request("GET", api, auth_info, path)["virtual-router"]
+    if vrouter.get("virtual_router_ip_address") == ip:
+        log("virtual-router {} is already provisioned".format(name))
+        return
+    data = {"virtual-router": {"virtual_router_ip_address": ip}}
+    _request("PUT", api, auth_info, path, data)
+    log("virtual-router {} was updated with address {}".format(name, ip))
+
+
+def delete_virtual_router(api, auth_info, name):
+    uuid = _get_virtual_router_id(api, auth_info, name)
+    if not uuid:
+        log("virtual-router {} is already absent".format(name))
+        return
+    _request("DELETE", api, auth_info, "/virtual-router/" + uuid,
+             allow_missing=True)
+    log("virtual-router {} was deleted".format(name))
+
+
+def update_global_vrouter_config(api, auth_info, settings):
+    """Sets properties of global-vrouter-config that are applied by all
+    vrouter agents. Property with None value is cleared.
+    """
+    data = {"type": "global-vrouter-config",
+            "fq_name": [GLOBAL_SYSTEM_CONFIG, GLOBAL_VROUTER_CONFIG]}
+    uuid = _request("POST", api, auth_info, "/fqname-to-id", data)["uuid"]
+    _request("PUT", api, auth_info, "/global-vrouter-config/" + uuid,
+             {"global-vrouter-config": settings})
+    log("global-vrouter-config was updated with {}".format(settings))
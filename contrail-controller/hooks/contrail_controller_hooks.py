@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import json
+from multiprocessing import cpu_count
 import sys
 import uuid
 import yaml
@@ -21,7 +22,6 @@ from charmhelpers.core.hookenv import (
     status_set,
     remote_unit,
     local_unit,
-    ERROR,
 )
 
 from charmhelpers.fetch import (
@@ -32,11 +32,27 @@ from charmhelpers.fetch import (
 
 from contrail_controller_utils import (
     update_charm_status,
+    upgrade_container,
+    API_PORT,
+    CLUSTER_NAME,
     CONTAINER_NAME,
     get_analytics_list,
     get_controller_ips,
+    get_graceful_restart_info,
+    get_pci_whitelists,
+    get_api_ports,
+    get_relation_ids,
+    update_api_ports,
+    update_flow_export_rate,
+    get_webui_redis,
+    get_external_services,
+    API_WRITE_PORT,
+    SYSCTL_FILE,
+    SYSCTL_PROFILES,
 )
 from common_utils import (
+    grant_upgrade_lease,
+    request_upgrade,
     get_ip,
     fix_hostname,
     json_loads,
@@ -45,7 +61,9 @@ from docker_utils import (
     add_docker_repo,
     DOCKER_PACKAGES,
     is_container_launched,
+    update_container_resources,
 )
+from sysctl_utils import configure_sysctl
 
 PACKAGES = []
 
@@ -84,37 +102,35 @@ def leader_elected():
                    rabbitmq_vhost=vhost)
         update_northbound_relations()
 
-    ip_list = leader_get("controller_ip_list")
-    ips = get_controller_ips()
-    if not ip_list:
-        ip_list = ips.values()
-        log("IP_LIST: {}    IPS: {}".format(str(ip_list), str(ips)))
-        leader_set(controller_ip_list=json.dumps(ip_list),
-                   controller_ips=json.dumps(ips))
-        # TODO: pass this list to all south/north relations
-    else:
-        current_ip_list = ips.values()
-        dead_ips = set(ip_list).difference(current_ip_list)
-        new_ips = set(current_ip_list).difference(ip_list)
-        if new_ips:
-            log("There are a new controllers that are not in the list: "
-                + str(new_ips), level=ERROR)
-        if dead_ips:
-            log("There are a dead controllers that are in the list: "
-                + str(dead_ips), level=ERROR)
+    # reconcile membership with units that are in the cluster now
+    ips = dict((unit, ip) for unit, ip in get_controller_ips().items() if ip)
+    _update_membership(ips)
 
+    update_haproxy_backends()
     update_charm_status()
+    grant_upgrade_lease(CLUSTER_NAME)
+    upgrade_container()
 
 
 @hooks.hook("leader-settings-changed")
 def leader_settings_changed():
+    upgrade_container()
+    update_haproxy_services()
+    # settings that are rendered into config. backends, for example, are
+    # changed more often and don't require container config update
+    settings = json.dumps([leader_get(key) for key in (
+        "controller_generation", "db_user", "db_password", "rabbitmq_user",
+        "rabbitmq_password", "rabbitmq_vhost")])
+    if settings == config.get("leader_settings"):
+        log("Membership and credentials are not changed, skip rendering")
+        return
+    config["leader_settings"] = settings
     update_charm_status()
 
 
 @hooks.hook("controller-cluster-relation-joined")
 def cluster_joined():
-    settings = {"unit-address": get_ip()}
-    relation_set(relation_settings=settings)
+    relation_set(relation_settings=_cluster_settings())
     update_charm_status()
 
 
@@ -122,6 +138,8 @@ def cluster_joined():
 def cluster_changed():
     if not is_leader():
         return
+    grant_upgrade_lease(CLUSTER_NAME)
+    upgrade_container()
     data = relation_get()
     ip = data.get("unit-address")
     if not ip:
@@ -129,43 +147,64 @@ def cluster_changed():
         return
     unit = remote_unit()
     _address_changed(unit, ip)
+    update_haproxy_backends()
     update_charm_status()
 
 
+def _unit_number(unit):
+    return int(unit.split("/")[-1])
+
+
+def _update_membership(ips):
+    """Stores new membership of cluster and increments its generation.
+
+    Units that stay in the cluster keep their positions in
+    controller_ip_list, new units are appended in order of unit numbers.
+    Returns True if membership was changed.
+    """
+    old_ips = json_loads(leader_get("controller_ips"), dict())
+    old_list = json_loads(leader_get("controller_ip_list"), list())
+    units = dict((ip, unit) for unit, ip in old_ips.items())
+    order = [units[ip] for ip in old_list if units.get(ip) in ips]
+    order.extend(sorted(set(ips).difference(order), key=_unit_number))
+    ip_list = [ips[unit] for unit in order]
+    if ips == old_ips and ip_list == old_list:
+        return False
+
+    added = set(ips).difference(old_ips)
+    removed = set(old_ips).difference(ips)
+    if added:
+        log("Controllers joined the cluster: " + ", ".join(sorted(added)))
+    if removed:
+        log("Controllers left the cluster: " + ", ".join(sorted(removed)))
+    generation = int(leader_get("controller_generation") or 0) + 1
+    log("IP_LIST: {}    IPS: {}    GENERATION: {}".format(
+        str(ip_list), str(ips), generation))
+    leader_set(controller_ip_list=json.dumps(ip_list),
+               controller_ips=json.dumps(ips),
+               controller_generation=generation)
+    return True
+
+
 def _address_changed(unit, ip):
-    ip_list = json_loads(leader_get("controller_ip_list"), list())
     ips = json_loads(leader_get("controller_ips"), dict())
-    if ip in ip_list:
-        return
-    old_ip = ips.get(unit)
-    if old_ip:
-        index = ip_list.index(old_ip)
-        ip_list[index] = ip
-        ips[unit] = ip
-    else:
-        ip_list.append(ip)
-        ips[unit] = ip
-
-    log("IP_LIST: {}    IPS: {}".format(str(ip_list), str(ips)))
-    leader_set(controller_ip_list=json.dumps(ip_list),
-               controller_ips=json.dumps(ips))
+    ips[unit] = ip
+    _update_membership(ips)
 
 
 @hooks.hook("controller-cluster-relation-departed")
 def cluster_departed():
     if not is_leader():
         return
+    grant_upgrade_lease(CLUSTER_NAME)
+    upgrade_container()
     unit = remote_unit()
     ips = json_loads(leader_get("controller_ips"), dict())
     if unit not in ips:
         return
-    old_ip = ips.pop(unit)
-    ip_list = json_loads(leader_get("controller_ip_list"), list())
-    ip_list.remove(old_ip)
-
-    log("IP_LIST: {}    IPS: {}".format(str(ip_list), str(ips)))
-    leader_set(controller_ip_list=json.dumps(ip_list),
-               controller_ips=json.dumps(ips))
+    del ips[unit]
+    _update_membership(ips)
+    update_haproxy_backends()
     update_charm_status()
 
 
@@ -176,6 +215,12 @@ def config_changed():
         raise Exception("Config is invalid. auth-mode must one of: "
                         "rbac, cloud-admin, no-auth.")
 
+    configure_sysctl(SYSCTL_PROFILES, SYSCTL_FILE)
+
+    if (config.changed("api-workers")
+            and is_container_launched(CONTAINER_NAME)):
+        update_api_ports()
+
     if config.changed("control-network"):
         ip = get_ip()
         settings = {"private-address": ip}
@@ -185,22 +230,28 @@ def config_changed():
         for rname in rnames:
             for rid in relation_ids(rname):
                 relation_set(relation_id=rid, relation_settings=settings)
-        settings = {"unit-address": ip}
-        for rid in relation_ids("controller-cluster"):
-            relation_set(relation_id=rid, relation_settings=settings)
         if is_leader():
             _address_changed(local_unit(), ip)
 
+    for rid in relation_ids("controller-cluster"):
+        relation_set(relation_id=rid, relation_settings=_cluster_settings())
+    if is_leader():
+        update_haproxy_backends()
+    else:
+        update_haproxy_services()
+    update_container_resources(CONTAINER_NAME)
     update_charm_status()
 
     if not is_leader():
         return
 
+    update_flow_export_rate()
     update_northbound_relations()
     update_southbound_relations()
 
 
 def update_northbound_relations(rid=None):
+    external = get_external_services()
     settings = {
         "auth-mode": config.get("auth-mode"),
         "auth-info": config.get("auth_info"),
@@ -209,8 +260,10 @@ def update_northbound_relations(rid=None):
         "ssl-cert": config.get("ssl_cert"),
         "ssl-key": config.get("ssl_key"),
         "rabbitmq_user": leader_get("rabbitmq_user"),
-        "rabbitmq_password": leader_get("rabbitmq_password"),
+        "rabbitmq_password": (external.get("rabbitmq_password")
+                              or leader_get("rabbitmq_password")),
         "rabbitmq_vhost": leader_get("rabbitmq_vhost"),
+        "rabbitmq-servers": json.dumps(external["external_rabbitmq_servers"]),
     }
 
     if rid:
@@ -231,6 +284,8 @@ def update_southbound_relations(rid=None):
         "auth-info": config.get("auth_info"),
         "ssl-ca": config.get("ssl_ca"),
         "orchestrator-info": config.get("orchestrator_info"),
+        "graceful-restart-info": json.dumps(get_graceful_restart_info()),
+        "pci-whitelists": json.dumps(get_pci_whitelists()),
     }
     for rid in ([rid] if rid else relation_ids("contrail-controller")):
         relation_set(relation_id=rid, relation_settings=settings)
@@ -238,7 +293,8 @@ def update_southbound_relations(rid=None):
 
 @hooks.hook("contrail-controller-relation-joined")
 def contrail_controller_joined():
-    settings = {"private-address": get_ip(), "port": 8082}
+    # workers are reachable through HAProxy frontend only
+    settings = {"private-address": get_ip(), "port": API_PORT}
     relation_set(relation_settings=settings)
     if is_leader():
         update_southbound_relations(rid=relation_id())
@@ -259,6 +315,8 @@ def contrail_controller_changed():
 
 @hooks.hook("contrail-controller-relation-departed")
 def contrail_controller_departed():
+    if is_leader():
+        update_southbound_relations()
     if not remote_unit().startswith("contrail-openstack-compute"):
         return
 
@@ -332,77 +390,286 @@ def contrail_auth_departed():
 
 @hooks.hook("update-status")
 def update_status():
+    upgrade_container()
     update_charm_status(update_config=False)
+    update_flow_export_rate()
 
 
 @hooks.hook("upgrade-charm")
 def upgrade_charm():
-    # NOTE: old image can not be deleted if container is running.
-    # TODO: so think about killing the container
-
     # NOTE: this hook can be fired when either resource changed or charm code
-    # changed. so if code was changed then we may need to update config
+    # changed. new image is loaded beside running container and container is
+    # replaced when leader gives the lease to this unit.
+    if request_upgrade(CLUSTER_NAME, CONTAINER_NAME):
+        upgrade_container()
+        return
+
+    # code was changed so we may need to update config
     update_charm_status()
 
 
-def _http_services():
-    name = local_unit().replace("/", "-")
-    addr = get_ip()
+HAPROXY_MAX_WEIGHT = 256
+HAPROXY_BALANCE = ("roundrobin", "leastconn", "source", "first")
+HAPROXY_HTTP_REUSE = ("never", "safe", "aggressive", "always")
+API_WRITE_METHODS = "POST PUT PATCH DELETE"
+
+
+def _get_capacity():
+    """Returns HAProxy weight of this unit: number of cores or 0 if unit
+    is drained.
+    """
+    if config.get("haproxy-drain"):
+        return 0
+    return min(cpu_count(), HAPROXY_MAX_WEIGHT)
+
+
+def _cluster_settings():
+    return {
+        "unit-address": get_ip(),
+        "api-ports": json.dumps(get_api_ports()),
+        "capacity": _get_capacity(),
+    }
+
+
+def _get_haproxy_backends():
+    """Returns list of (name, address, api ports, weight) for all units.
+
+    List is maintained by leader, so all units publish the same servers in
+    the same order. Before leader publishes it only this unit is used.
+    """
+    backends = json_loads(leader_get("haproxy_backends"), list())
+    if backends:
+        return backends
+    return [[local_unit().replace("/", "-"), get_ip(), get_api_ports(),
+             _get_capacity()]]
+
+
+def update_haproxy_backends():
+    """Publishes backends of all units in order of controller_ip_list."""
+    ip_list = json_loads(leader_get("controller_ip_list"), list())
+    ips = json_loads(leader_get("controller_ips"), dict())
+    units = {local_unit(): _cluster_settings()}
+    for rid in relation_ids("controller-cluster"):
+        for unit in related_units(rid):
+            units[unit] = relation_get(unit=unit, rid=rid)
+
+    backends = list()
+    for ip in ip_list:
+        unit = next((unit for unit, uip in ips.items() if uip == ip), None)
+        data = units.get(unit)
+        if not data or not data.get("api-ports"):
+            continue
+        backends.append([unit.replace("/", "-"), ip,
+                         json_loads(data["api-ports"]),
+                         int(data.get("capacity", 1))])
+    backends = json.dumps(backends)
+    if backends != leader_get("haproxy_backends"):
+        leader_set(haproxy_backends=backends)
+    # leader doesn't receive leader-settings-changed for own changes
+    update_haproxy_services()
+
+
+def _haproxy_options():
+    balance = config.get("haproxy-balance")
+    if balance not in HAPROXY_BALANCE:
+        raise Exception("haproxy-balance must be one of: "
+                        + ", ".join(HAPROXY_BALANCE))
+    reuse = config.get("haproxy-http-reuse")
+    if reuse and reuse not in HAPROXY_HTTP_REUSE:
+        raise Exception("haproxy-http-reuse must be one of: "
+                        + ", ".join(HAPROXY_HTTP_REUSE))
+    for key in ("haproxy-server-maxconn", "haproxy-check-inter",
+                "haproxy-check-rise", "haproxy-check-fall"):
+        if config.get(key) < 1:
+            raise Exception(key + " must be a positive number")
+    write_workers = config.get("api-write-workers")
+    if write_workers and write_workers >= config.get("api-workers"):
+        raise Exception("api-write-workers must be less than api-workers")
+    return balance, reuse, write_workers
+
+
+def _api_check(weight):
+    check = "check inter {} rise {} fall {}".format(
+        config.get("haproxy-check-inter"), config.get("haproxy-check-rise"),
+        config.get("haproxy-check-fall"))
+    return "{} maxconn {} weight {}".format(
+        check, config.get("haproxy-server-maxconn"), weight)
+
+
+def _webui_options(balance):
+    options = [
+        "timeout client 86400000",
+        "mode http",
+        "balance " + balance,
+        "timeout server 30000",
+        "timeout connect 4000",
+    ]
+    # sessions are kept in shared redis, so requests of one session can
+    # go to any unit
+    if not get_webui_redis():
+        options.insert(3, "cookie SERVERID insert indirect nocache")
+    return options
+
+
+def _webui_servers(port):
+    # all workers of unit share the same port
+    maxconn = config.get("haproxy-server-maxconn") * config.get("webui-workers")
+    cookie = not get_webui_redis()
     return [
+        [name, addr, port,
+         "{}weight {} maxconn {} check port {}".format(
+             "cookie {} ".format(addr) if cookie else "", weight, maxconn,
+             api_ports[0])]
+        for name, addr, api_ports, weight in _get_haproxy_backends()]
+
+
+def _api_service_options(balance, reuse, http):
+    options = [
+        "timeout client 3m",
+        "option nolinger",
+        "timeout server 3m",
+        "balance " + balance,
+    ]
+    if http:
+        options.extend(["mode http", "option http-keep-alive"])
+        if reuse:
+            options.append("http-reuse " + reuse)
+    if config.get("haproxy-health-check"):
+        options.append("option httpchk GET " +
+                       config.get("haproxy-health-check"))
+    return options
+
+
+def _http_services():
+    balance, reuse, write_workers = _haproxy_options()
+
+    def _api_servers(pool):
+        servers = list()
+        for name, addr, api_ports, weight in _get_haproxy_backends():
+            ports = (api_ports[:write_workers] if pool == "write"
+                     else api_ports[write_workers:])
+            if len(api_ports) <= write_workers:
+                # workers of unit are not started yet
+                ports = api_ports
+            servers.extend(
+                ["{}-{}".format(name, port) if len(api_ports) > 1 else name,
+                 addr, port, _api_check(weight)]
+                for port in ports)
+        return servers
+
+    # write requests are routed to the first workers when pools are separate
+    http = bool(reuse or write_workers)
+    api_options = _api_service_options(balance, reuse, http)
+    services = [
         {"service_name": "contrail-webui-http",
          "service_host": "*",
          "service_port": 8080,
-         "service_options": [
-            "timeout client 86400000",
-            "mode http",
-            "balance roundrobin",
-            "cookie SERVERID insert indirect nocache",
-            "timeout server 30000",
-            "timeout connect 4000",
-         ],
-         "servers": [[name, addr, 8080,
-            "cookie " + addr + " weight 1 maxconn 1024 check port 8082"]]},
+         "service_options": _webui_options(balance),
+         "servers": _webui_servers(8080)},
         {"service_name": "contrail-api",
          "service_host": "*",
          "service_port": 8082,
-         "service_options": [
-            "timeout client 3m",
-            "option nolinger",
-            "timeout server 3m",
-            "balance roundrobin",
-         ],
-         "servers": [[name, addr, 8082, "check inter 2000 rise 2 fall 3"]]}
+         "service_options": api_options,
+         "servers": _api_servers("read")},
     ]
+    if write_workers:
+        services[1]["service_options"] = api_options + [
+            "acl write_method method " + API_WRITE_METHODS,
+            "use_backend contrail-api-write if write_method",
+        ]
+        services.append(
+            {"service_name": "contrail-api-write",
+             "service_host": "*",
+             "service_port": API_WRITE_PORT,
+             "service_options": api_options,
+             "servers": _api_servers("write")})
+    return services
 
 
 @hooks.hook("http-services-relation-joined")
 def http_services_joined():
-    relation_set(services=yaml.dump(_http_services()))
+    services = yaml.safe_dump(_http_services(), default_flow_style=False)
+    relation_set(services=services)
+    _update_api_workers()
+
+
+@hooks.hook("http-services-relation-broken")
+def http_services_broken():
+    _update_api_workers()
+
+
+def _update_api_workers():
+    # workers of contrail-api are started only behind HAProxy
+    if is_container_launched(CONTAINER_NAME):
+        update_api_ports()
+    for rid in relation_ids("controller-cluster"):
+        relation_set(relation_id=rid, relation_settings=_cluster_settings())
+    if is_leader():
+        update_haproxy_backends()
+    update_charm_status()
 
 
 def _https_services():
-    name = local_unit().replace("/", "-")
-    addr = get_ip()
+    balance, _, _ = _haproxy_options()
     return [
         {"service_name": "contrail-webui-https",
          "service_host": "*",
          "service_port": 8143,
-         "service_options": [
-            "timeout client 86400000",
-            "mode http",
-            "balance roundrobin",
-            "cookie SERVERID insert indirect nocache",
-            "timeout server 30000",
-            "timeout connect 4000",
-         ],
-         "servers": [[name, addr, 8143,
-            "cookie " + addr + " weight 1 maxconn 1024 check port 8082"]]},
+         "service_options": _webui_options(balance),
+         "servers": _webui_servers(8143)},
     ]
 
 
 @hooks.hook("https-services-relation-joined")
 def https_services_joined():
-    relation_set(services=yaml.dump(_https_services()))
+    services = yaml.safe_dump(_https_services(), default_flow_style=False)
+    relation_set(services=services)
+
+
+def _validate_services(services):
+    for service in services:
+        for key in ("service_name", "service_port", "servers"):
+            if not service.get(key):
+                raise Exception("HAProxy service definition misses " + key)
+        for server in service["servers"]:
+            if len(server) != 4:
+                raise Exception("Invalid server in HAProxy service {}: {}"
+                                .format(service["service_name"], server))
+
+
+def update_haproxy_services():
+    """Pushes HAProxy services to relations if they were changed."""
+    for rname, func in (("http-services", _http_services),
+                        ("https-services", _https_services)):
+        services = func()
+        _validate_services(services)
+        # haproxy charm loads services with yaml.safe_load
+        data = yaml.safe_dump(services, default_flow_style=False)
+        key = rname.replace("-", "_")
+        if config.get(key) == data:
+            continue
+        for rid in get_relation_ids(rname):
+            relation_set(relation_id=rid, services=data)
+        config[key] = data
+
+
+@hooks.hook("amqp-relation-joined")
+def amqp_joined():
+    relation_set(username=leader_get("rabbitmq_user"),
+                 vhost=leader_get("rabbitmq_vhost"))
+
+
+@hooks.hook("amqp-relation-changed", "amqp-relation-departed")
+def amqp_changed():
+    update_charm_status()
+    if is_leader():
+        update_northbound_relations()
+
+
+@hooks.hook("cassandra-relation-changed", "cassandra-relation-departed",
+            "zookeeper-relation-changed", "zookeeper-relation-departed")
+def external_services_changed():
+    update_charm_status()
 
 
 def main():
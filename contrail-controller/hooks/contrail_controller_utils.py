@@ -1,3 +1,5 @@
+import json
+from multiprocessing import cpu_count
 from socket import inet_aton
 import struct
 
@@ -5,17 +7,28 @@ import apt_pkg
 
 from charmhelpers.core.hookenv import (
     config,
+    hook_name,
     related_units,
+    relation_id,
     relation_ids,
     relation_get,
     status_set,
+    is_leader,
     leader_get,
+    leader_set,
     log,
     open_port,
+    close_port,
     local_unit,
+    storage_get,
+    storage_list,
+    WARNING,
 )
+from charmhelpers.core.host import get_total_ram
 from charmhelpers.core.templating import render
 
+from contrail_api_utils import update_global_vrouter_config
+from docker_utils import is_container_launched
 from common_utils import (
     get_ip,
     decode_cert,
@@ -23,6 +36,8 @@ from common_utils import (
     check_run_prerequisites,
     run_container,
     json_loads,
+    upgrade_if_leased,
+    get_performance_settings,
 )
 
 
@@ -33,6 +48,38 @@ config = config()
 CONTAINER_NAME = "contrail-controller"
 CONFIG_NAME = "controller"
 SERVICES_TO_CHECK = ["contrail-control", "contrail-api", "contrail-webui"]
+CLUSTER_NAME = "controller-cluster"
+
+API_PORT = 8082
+# contrail-api workers listen on consecutive ports starting from this one
+API_WORKER_BASE_PORT = 9100
+# port of HAProxy service for write requests when pools are separate
+API_WRITE_PORT = 8182
+# juju storage and its path inside container
+CONTAINER_STORAGE = {
+    "cassandra-data": "/var/lib/cassandra/data",
+    "cassandra-commitlog": "/var/lib/cassandra/commitlog",
+}
+
+SYSCTL_FILE = "/etc/sysctl.d/60-contrail-controller.conf"
+SYSCTL_PROFILES = {
+    # control nodes keep XMPP sessions to every agent and BGP sessions to
+    # peers, API and WebUI serve many concurrent clients
+    "controller-many-sessions": {
+        "net.core.somaxconn": 16384,
+        "net.core.netdev_max_backlog": 65536,
+        "net.core.rmem_max": 16777216,
+        "net.core.wmem_max": 16777216,
+        "net.ipv4.tcp_rmem": "4096 87380 16777216",
+        "net.ipv4.tcp_wmem": "4096 65536 16777216",
+        "net.ipv4.tcp_max_syn_backlog": 16384,
+        "net.ipv4.ip_local_port_range": "10240 65000",
+        "net.netfilter.nf_conntrack_max": 524288,
+        "net.ipv4.neigh.default.gc_thresh1": 1024,
+        "net.ipv4.neigh.default.gc_thresh2": 4096,
+        "net.ipv4.neigh.default.gc_thresh3": 8192,
+    },
+}
 
 
 def get_controller_ips():
@@ -57,6 +104,199 @@ def get_analytics_list():
     return analytics_ip_list
 
 
+def get_pci_whitelists():
+    """Returns PCI whitelists of computes published by agents"""
+    whitelists = dict()
+    for rid in relation_ids("contrail-controller"):
+        for unit in related_units(rid):
+            whitelist = json_loads(
+                relation_get("pci-whitelist", unit, rid), list())
+            if whitelist:
+                hostname = relation_get("hostname", unit, rid)
+                whitelists[hostname] = whitelist
+    return whitelists
+
+
+def get_graceful_restart_info():
+    if not config.get("graceful-restart"):
+        return None
+    return {
+        "restart_time": config.get("graceful-restart-time"),
+        "long_lived_restart_time":
+            config.get("long-lived-graceful-restart-time"),
+        "end_of_rib_timeout": config.get("end-of-rib-timeout"),
+    }
+
+
+def get_relation_ids(rname):
+    """Returns ids of relations except the one that is being removed.
+
+    Relation is still listed by relation-ids in its relation-broken hook.
+    """
+    rids = relation_ids(rname)
+    if hook_name() == rname + "-relation-broken":
+        rids = [rid for rid in rids if rid != relation_id()]
+    return rids
+
+
+def get_api_workers():
+    """Returns number of contrail-api processes.
+
+    Workers don't listen on port 8082, so they are started only when
+    HAProxy of http-services relation serves it. Otherwise single process
+    listens on 8082.
+    """
+    workers = config.get("api-workers")
+    if workers < 1:
+        raise Exception("api-workers must be a positive number")
+    return workers if get_relation_ids("http-services") else 1
+
+
+def get_api_ports():
+    """Returns local ports of contrail-api processes."""
+    workers = get_api_workers()
+    if workers == 1:
+        return [API_PORT]
+    return [API_WORKER_BASE_PORT + i for i in range(workers)]
+
+
+def update_api_ports():
+    """Opens ports of contrail-api workers and closes ports of workers that
+    were removed.
+    """
+    ports = get_api_ports()
+    for port in config.get("opened-api-ports", []):
+        if port not in ports:
+            close_port(port, "TCP")
+    for port in ports:
+        open_port(port, "TCP")
+    config["opened-api-ports"] = ports
+
+
+def update_flow_export_rate():
+    """Sets rate of flow records exported by each vrouter agent in
+    global-vrouter-config.
+
+    It's done by leader when API is up. Applied value is kept in leader
+    data and failed attempt is repeated by next hooks. Value that was
+    applied before is cleared in the API when the option is unset.
+    """
+    rate = config.get("flow-export-rate")
+    applied = leader_get("flow_export_rate")
+    if (not is_leader() or (rate is None and not applied)
+            or (rate is not None and str(rate) == applied)
+            or not is_container_launched(CONTAINER_NAME)):
+        return
+    api = (get_ip(), get_api_ports()[0])
+    auth_info = json_loads(config.get("auth_info"), dict())
+    try:
+        update_global_vrouter_config(api, auth_info,
+                                     {"flow_export_rate": rate})
+    except Exception as e:
+        log("Couldn't set flow export rate: " + str(e), level=WARNING)
+        return
+    # None removes the key from leader data
+    leader_set(flow_export_rate=rate)
+
+
+def get_webui_redis():
+    """Returns (host, port) of shared redis for WebUI or None."""
+    value = config.get("webui-redis")
+    if not value:
+        return None
+    host, _, port = value.partition(":")
+    try:
+        return host, int(port or 6379)
+    except ValueError:
+        raise Exception("webui-redis must be in form host[:port]")
+
+
+def _profile_settings(profile, cores, ram):
+    # resources created before R1.05 can't be listed with optimization, so
+    # it's enabled only explicitly by 'custom' profile
+    return {
+        "api_list_optimization": False,
+    }
+
+
+def get_storage_mounts():
+    """Returns attached storage as dict of path in container to location
+    on host.
+    """
+    mounts = dict()
+    for name, path in CONTAINER_STORAGE.items():
+        for storage_id in storage_list(name) or []:
+            mounts[path] = storage_get("location", storage_id)
+    return mounts
+
+
+def _get_storage_args():
+    return ["--volume={}:{}".format(location, path)
+            for path, location in sorted(get_storage_mounts().items())]
+
+
+def get_cassandra_context():
+    """Returns storage directories and heap sizes of config database.
+
+    Heap is sized from total RAM and cores like cassandra-env.sh does unless
+    it's set explicitly.
+    """
+    ram = get_total_ram() // 1024 ** 2
+    heap = max(min(ram // 2, 1024), min(ram // 4, 8192))
+    newsize = min(100 * cpu_count(), heap // 4)
+    mounts = get_storage_mounts()
+    data_dir = CONTAINER_STORAGE["cassandra-data"]
+    commitlog_dir = CONTAINER_STORAGE["cassandra-commitlog"]
+    return {
+        "data_dirs": json.dumps([data_dir]) if data_dir in mounts else None,
+        "commitlog_dir": commitlog_dir if commitlog_dir in mounts else None,
+        "heap_size": config.get("cassandra-heap-size") or "{}M".format(heap),
+        "heap_newsize": (config.get("cassandra-heap-newsize")
+                         or "{}M".format(newsize)),
+    }
+
+
+def _get_relation_servers(rname, port_key, default_port):
+    servers = list()
+    for rid in relation_ids(rname):
+        for unit in related_units(rid):
+            data = relation_get(unit=unit, rid=rid) or {}
+            host = data.get("host") or data.get("private-address")
+            if host:
+                servers.append("{}:{}".format(
+                    host, data.get(port_key) or default_port))
+    return sorted(servers)
+
+
+def _get_relation_value(rname, key):
+    for rid in relation_ids(rname):
+        for unit in related_units(rid):
+            value = relation_get(key, unit, rid)
+            if value:
+                return value
+    return None
+
+
+def get_external_services():
+    """Returns servers and credentials of external cassandra, zookeeper and
+    rabbitmq. Services in container are used for absent relations.
+    """
+    ctx = {
+        "external_configdb_servers": _get_relation_servers(
+            "cassandra", "rpc_port", 9160),
+        "external_zookeeper_servers": _get_relation_servers(
+            "zookeeper", "port", 2181),
+        "external_rabbitmq_servers": _get_relation_servers(
+            "amqp", "port", 5672),
+    }
+    if ctx["external_configdb_servers"]:
+        ctx["db_user"] = _get_relation_value("cassandra", "username")
+        ctx["db_password"] = _get_relation_value("cassandra", "password")
+    if ctx["external_rabbitmq_servers"]:
+        ctx["rabbitmq_password"] = _get_relation_value("amqp", "password")
+    return ctx
+
+
 def get_context():
     ctx = {}
     ctx["auth_mode"] = config.get("auth-mode")
@@ -76,11 +316,21 @@ def get_context():
     ctx["rabbitmq_user"] = leader_get("rabbitmq_user")
     ctx["rabbitmq_password"] = leader_get("rabbitmq_password")
     ctx["rabbitmq_vhost"] = leader_get("rabbitmq_vhost")
+    ctx.update(dict((key, value)
+                    for key, value in get_external_services().items()
+                    if value))
 
     ips = json_loads(leader_get("controller_ip_list"), list())
     ctx["controller_servers"] = ips
     ctx["config_seeds"] = ips
     ctx["analytics_servers"] = get_analytics_list()
+    ctx["graceful_restart"] = get_graceful_restart_info()
+    ctx["api_workers"] = get_api_workers()
+    ctx["api_worker_base_port"] = API_WORKER_BASE_PORT
+    ctx["webui_workers"] = config.get("webui-workers")
+    ctx["webui_redis"] = get_webui_redis()
+    ctx.update(get_performance_settings(_profile_settings))
+    ctx["cassandra"] = get_cassandra_context()
     log("CTX: " + str(ctx))
     ctx.update(json_loads(config.get("auth_info"), dict()))
     return ctx
@@ -116,6 +366,16 @@ def update_charm_status(update_config=True):
         missing_relations.append("contrail-controller-cluster")
     if not ctx.get("analytics_servers"):
         missing_relations.append("contrail-analytics")
+    for rname, key in (("cassandra", "external_configdb_servers"),
+                       ("zookeeper", "external_zookeeper_servers"),
+                       ("amqp", "external_rabbitmq_servers")):
+        if relation_ids(rname) and not ctx.get(key):
+            status_set("waiting", "Waiting for external " + rname)
+            return
+    if (ctx.get("external_rabbitmq_servers")
+            and not ctx.get("rabbitmq_password")):
+        status_set("waiting", "Waiting for password from amqp relation")
+        return
     if get_ip() not in ctx.get("controller_servers"):
         missing_relations.append("contrail-cluster")
     if missing_relations:
@@ -133,7 +393,14 @@ def update_charm_status(update_config=True):
     # TODO: what should happens if relation departed?
 
     render_config(ctx)
-    for port in ("8082", "8080", "8143"):
+    update_api_ports()
+    for port in [8080, 8143]:
         open_port(port, "TCP")
 
-    run_container(CONTAINER_NAME, "contrail-control")
+    run_container(CONTAINER_NAME, "contrail-control",
+                  additional_args=_get_storage_args())
+
+
+def upgrade_container():
+    upgrade_if_leased(CLUSTER_NAME, CONTAINER_NAME, "contrail-control",
+                      SERVICES_TO_CHECK, _get_storage_args())
@@ -1,4 +1,6 @@
 import functools
+import hashlib
+from multiprocessing import cpu_count
 from time import sleep, time
 
 from subprocess import (
@@ -11,6 +13,7 @@ from charmhelpers.core.hookenv import (
     config,
     log,
     ERROR,
+    WARNING,
 )
 
 
@@ -19,6 +22,8 @@ config = config()
 
 DOCKER_PACKAGES = ["docker.engine"]
 DOCKER_CLI = "/usr/bin/docker"
+NUMA_NODES = "/sys/devices/system/node/online"
+RESOURCE_OPTIONS = ("cpuset-cpus", "memory-limit", "numa-node")
 
 
 def retry(f=None, timeout=10, delay=2):
@@ -77,25 +82,24 @@ def add_docker_repo():
     check_output(cmd, shell=True)
 
 
-def is_container_launched(name):
-    # NOTE: 'paused' state is not getting into account if someone paused it
-    # NOTE: assume that this cmd is the same as inspect of state:
-    # [DOCKER_CLI, "inspect", "-f", "{{.State.Running}}", name]
-    cmd = DOCKER_CLI + ' ps | grep -w ' + name
+def _get_container_state(name):
+    # NOTE: container is matched by exact name, 'ps | grep -w' would match
+    # previous container that is kept during upgrade too
     try:
-        check_output(cmd, shell=True)
-        return True
+        output = check_output([DOCKER_CLI, "inspect", "--type=container",
+                               "-f", "{{.State.Running}}", name])
     except CalledProcessError:
-        return False
+        return None
+    return output.decode("UTF-8").strip()
+
+
+def is_container_launched(name):
+    # NOTE: 'paused' state is not getting into account if someone paused it
+    return _get_container_state(name) == "true"
 
 
 def is_container_present(name):
-    cmd = DOCKER_CLI + ' ps --all | grep -w ' + name
-    try:
-        check_output(cmd, shell=True)
-        return True
-    except CalledProcessError:
-        return False
+    return _get_container_state(name) is not None
 
 
 def dpkg_version(name, pkg):
@@ -109,18 +113,81 @@ def dpkg_version(name, pkg):
         return None
 
 
-def load_docker_image(name):
+def get_resource_hash(name):
+    img_path = resource_get(name)
+    if not img_path:
+        return None
+    md5 = hashlib.md5()
+    with open(img_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def load_docker_image(name, keep_previous=False):
+    """Loads image from resource and returns its id.
+
+    Previous image can be kept if it's still used by running container.
+    """
     img_path = resource_get(name)
     if not img_path:
         return None
     image_id = get_docker_image_id(name)
-    if image_id:
+    if image_id and not keep_previous:
         # remove previous image
         check_call([DOCKER_CLI, "rmi", image_id])
-    check_call([DOCKER_CLI, "load", "-i", img_path])
+    output = check_output([DOCKER_CLI, "load", "-i", img_path])
+    for line in output.decode("UTF-8").splitlines():
+        # docker 1.12+ reports reference or id of loaded image
+        if line.startswith("Loaded image"):
+            return get_image_id(line.split(":", 1)[1].strip())
     return get_docker_image_id(name)
 
 
+def get_image_id(image):
+    """Returns full id of image or None if image is absent."""
+    try:
+        output = check_output([DOCKER_CLI, "inspect", "--type=image",
+                               "-f", "{{.Id}}", image])
+    except CalledProcessError:
+        return None
+    return output.decode("UTF-8").strip()
+
+
+def get_container_image_id(name):
+    output = check_output([DOCKER_CLI, "inspect", "-f", "{{.Image}}", name])
+    return output.decode("UTF-8").strip()
+
+
+def stop_container(name):
+    check_call([DOCKER_CLI, "stop", name])
+
+
+def start_container(name):
+    check_call([DOCKER_CLI, "start", name])
+
+
+def rename_container(name, new_name):
+    check_call([DOCKER_CLI, "rename", name, new_name])
+
+
+def remove_container(name):
+    check_call([DOCKER_CLI, "rm", "--force", name])
+
+
+@retry(timeout=60, delay=1)
+def wait_container_exec(name):
+    """Waits until commands can be executed in started container."""
+    check_call([DOCKER_CLI, "exec", name, "true"])
+
+
+def remove_image(image_id):
+    try:
+        check_call([DOCKER_CLI, "rmi", image_id])
+    except CalledProcessError:
+        log("Image {} can't be removed".format(image_id), level=WARNING)
+
+
 def get_docker_image_id(name):
     try:
         output = check_output(DOCKER_CLI + ' images | grep -w ' + name,
@@ -135,8 +202,8 @@ def get_docker_image_id(name):
     return None
 
 
-def launch_docker_image(name, additional_args=[]):
-    image_id = get_docker_image_id(name)
+def launch_docker_image(name, additional_args=[], image_id=None):
+    image_id = image_id or get_docker_image_id(name)
     if not image_id:
         log(name + " docker image is not available", level=ERROR)
         return
@@ -151,12 +218,50 @@ def launch_docker_image(name, additional_args=[]):
             "--env='CLOUD_ORCHESTRATOR=%s'" % (orchestrator),
             "--volume=/etc/contrailctl:/etc/contrailctl",
             "--name=%s" % name]
+    args.extend(get_resource_args())
     args.extend(additional_args)
     args.extend(["-itd", image_id])
     log("Run container with cmd: " + ' '.join(args))
     check_call(args)
 
 
+def get_resource_args(update=False):
+    """Returns docker arguments that place container on CPUs and NUMA node
+    and limit its memory.
+
+    For 'docker update' empty options are converted to all CPUs and nodes
+    because limits can't be removed from running container.
+    """
+    args = []
+    cpus = config.get("cpuset-cpus")
+    if not cpus and update:
+        cpus = "0-{}".format(cpu_count() - 1)
+    if cpus:
+        args.append("--cpuset-cpus=" + cpus)
+    mems = config.get("numa-node")
+    if not mems and update:
+        with open(NUMA_NODES) as f:
+            mems = f.read().strip()
+    if mems:
+        args.append("--cpuset-mems=" + mems)
+    if config.get("memory-limit"):
+        args.append("--memory=" + config["memory-limit"])
+    return args
+
+
+def update_container_resources(name):
+    if not any(config.changed(key) for key in RESOURCE_OPTIONS):
+        return
+    if not is_container_launched(name):
+        # options will be used when container is started
+        return
+    if config.changed("memory-limit") and not config.get("memory-limit"):
+        log("Memory limit can't be removed from running container " + name,
+            level=WARNING)
+    check_call([DOCKER_CLI, "update"] + get_resource_args(update=True)
+               + [name])
+
+
 def docker_cp(name, src, dst):
     check_call([DOCKER_CLI, "cp", name + ":" + src, dst])
 
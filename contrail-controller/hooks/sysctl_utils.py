@@ -0,0 +1,71 @@
+"""Kernel tuning with named sysctl profiles.
+
+Profiles are defined by each charm, settings of the profile can be
+overridden by YAML dictionary from 'sysctl' option.
+"""
+
+import os
+
+import yaml
+
+from charmhelpers.core.hookenv import (
+    config,
+    log,
+    WARNING,
+)
+from charmhelpers.core.sysctl import create as sysctl_create
+
+
+config = config()
+
+
+def sysctl_path(key):
+    """Returns key as path relative to /proc/sys.
+
+    Interface name in net.<proto>.conf.<iface>.<name> and
+    net.<proto>.neigh.<iface>.<name> keys can contain dots (e.g. VLAN
+    eth0.100), so it's kept as is and only other separators are converted.
+    Keys that are already given with '/' are returned unchanged.
+    """
+    if "/" in key:
+        return key
+    parts = key.split(".")
+    if len(parts) > 4 and parts[0] == "net" and parts[2] in ("conf", "neigh"):
+        parts[3:-1] = [".".join(parts[3:-1])]
+    return "/".join(parts)
+
+
+def configure_sysctl(profiles, sysctl_file):
+    """Applies sysctl profile with overrides from 'sysctl' option.
+
+    Profile is not applied if 'sysctl-profile' is empty. Keys are written
+    in '/' form, so dots in interface names are not treated as separators
+    by sysctl. Keys that are unknown to running kernel (e.g. conntrack
+    settings when module isn't loaded) are skipped, so sysctl doesn't fail
+    on them.
+    """
+    profile = config.get("sysctl-profile")
+    if profile and profile not in profiles:
+        raise Exception("Unknown sysctl profile: {}. Supported profiles: {}"
+                        .format(profile, ", ".join(sorted(profiles))))
+    values = dict(profiles.get(profile, {}))
+    try:
+        overrides = yaml.safe_load(config.get("sysctl") or "{}") or {}
+    except yaml.YAMLError:
+        overrides = None
+    if not isinstance(overrides, dict):
+        raise Exception("Option 'sysctl' must be a YAML dictionary")
+    values.update(overrides)
+
+    settings = dict()
+    for key, value in values.items():
+        path = sysctl_path(key)
+        if not os.path.exists(os.path.join("/proc/sys", path)):
+            log("Skip unknown sysctl key {}".format(key), level=WARNING)
+            continue
+        settings[path] = value
+    if not settings:
+        if os.path.exists(sysctl_file):
+            os.remove(sysctl_file)
+        return
+    sysctl_create(yaml.safe_dump(settings), sysctl_file)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import json
+import os
+from socket import gethostname
 from subprocess import CalledProcessError, check_output
 import sys
 import uuid
@@ -19,6 +21,7 @@ from charmhelpers.core.hookenv import (
     leader_set,
     is_leader,
     application_version_set,
+    WARNING,
 )
 
 from charmhelpers.core.host import (
@@ -103,11 +106,15 @@ def contrail_controller_changed():
     _update_config("api_vip", "api-vip")
     _update_config("api_ip", "private-address")
     _update_config("api_port", "port")
+    _update_config("pci_whitelists", "pci-whitelists")
     config.save()
     write_configs()
 
     status_set("active", "Unit is ready")
 
+    for rid in relation_ids("nova-compute"):
+        nova_compute_joined(rid)
+
     # auth_info can affect endpoints
     changed = update_service_ips()
     if changed and is_leader():
@@ -224,12 +231,38 @@ def nova_compute_joined(rel_id=None):
         }
       }
     }
+    pci_whitelist = _get_pci_whitelist()
+    if pci_whitelist:
+        conf["nova-compute"]["/etc/nova/nova.conf"]["sections"][
+            "DEFAULT"].append(
+                ("pci_passthrough_whitelist", json.dumps(pci_whitelist)))
     settings = {
         "metadata-shared-secret": leader_get("metadata-shared-secret"),
         "subordinate_configuration": json.dumps(conf)}
     relation_set(relation_id=rel_id, relation_settings=settings)
 
 
+def _get_pci_whitelist():
+    whitelists = config.get("pci_whitelists")
+    whitelists = json.loads(whitelists) if whitelists else {}
+    result = list()
+    for entry in whitelists.get(gethostname(), []):
+        # validate that host has virtual functions for this device
+        path = "/sys/class/net/{}/device/sriov_numvfs".format(
+            entry["devname"])
+        if not os.path.exists(path):
+            log("Device {} doesn't support SR-IOV".format(entry["devname"]),
+                level=WARNING)
+            continue
+        with open(path) as f:
+            if not int(f.read()):
+                log("Device {} doesn't have virtual functions"
+                    .format(entry["devname"]), level=WARNING)
+                continue
+        result.append(entry)
+    return result
+
+
 def main():
     try:
         hooks.execute(sys.argv)